@@ -1,4 +1,3 @@
-from ultralytics import YOLO
 import cv2
 import numpy as np
 import os
@@ -8,10 +7,27 @@ from tkinter import filedialog, messagebox, ttk
 from PIL import Image, ImageTk
 import threading
 from pathlib import Path
-import torch
+import sys
+import json
+import time
+import argparse
+import sqlite3
+import hashlib
+import errno
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import queue
+import contextlib
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from collections import OrderedDict, deque
+from itertools import repeat
+import multiprocessing
+from image_features import (extract_image_features, extract_orb_descriptors,
+                            init_feature_worker, extract_features_safe)
 
-device = 'cuda' if torch.cuda.is_available() else 'cpu'
-print(f"##############Device: {device}##############")
+# error/สถานะจากโค้ดที่ไม่มี self.log (LogSink ส่งต่อไปกล่อง log และไฟล์ log เมื่อเปิดแล้ว)
+logger = logging.getLogger(__name__)
 
 class DarkModeStyle:
     """คลาสสำหรับกำหนดสีและสไตล์ Dark Mode"""
@@ -44,6 +60,2003 @@ class DarkModeStyle:
     # ระยะห่าง
     PADDING = 10                   # ระยะห่างมาตรฐาน
 
+# Target classes in ImageNet related to vehicles and people
+TARGET_CLASS_KEYWORDS = [
+    # People
+    'person', 'man', 'woman', 'child', 'boy', 'girl', 'human',
+    # Bicycles
+    'bicycle', 'bike', 'cycle', 'mountain bike',
+    # Cars
+    'car', 'automobile', 'cab', 'taxi', 'jeep', 'sport car', 'passenger car',
+    # Motorcycles
+    'motorcycle', 'motorbike', 'motor scooter', 'scooter',
+    # Airplanes
+    'airplane', 'aircraft', 'plane', 'airliner', 'warplane', 'jet',
+    # Buses
+    'bus', 'coach', 'minibus', 'trolleybus',
+    # Trains
+    'train', 'locomotive', 'railway', 'railroad car', 'passenger car',
+    # Trucks
+    'truck', 'pickup', 'tractor', 'trailer truck', 'delivery truck',
+    # Boats
+    'boat', 'ship', 'sailboat', 'speedboat', 'canoe', 'vessel'
+]
+
+# โฟลเดอร์ผลลัพธ์ที่สร้างในโฟลเดอร์รูปภาพ
+OUTPUT_FOLDER_NAMES = ('car', 'not_car', 'person', 'car_auto')
+
+VALID_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp']
+
+# Car Auto จะย้ายเฉพาะรูปที่มั่นใจเกินค่านี้ (ถือว่า conf = 1.0)
+CAR_AUTO_MIN_CONFIDENCE = 0.9999
+
+def make_target_folders(folder_path):
+    """สร้าง dict ของโฟลเดอร์ผลลัพธ์ (และสร้างโฟลเดอร์จริงบนดิสก์)"""
+    target_folders = {name: os.path.join(folder_path, name) for name in OUTPUT_FOLDER_NAMES}
+    for folder in target_folders.values():
+        os.makedirs(folder, exist_ok=True)
+    return target_folders
+
+_VALID_EXTENSION_SET = frozenset(VALID_EXTENSIONS)
+
+def is_image_file(filename):
+    """ตรวจนามสกุลไฟล์ภาพ (ไม่แตะดิสก์)"""
+    return os.path.splitext(filename)[1].lower() in _VALID_EXTENSION_SET
+
+def iter_image_entries(folder_path, recursive=False, exclude=()):
+    """Yield directory entry ของไฟล์ภาพทีละไฟล์ระหว่างที่ os.scandir ไล่รายการ
+
+    ชนิดไฟล์มาจาก directory entry จึงไม่ต้อง stat ทีละไฟล์
+    ถ้า recursive จะไล่โฟลเดอร์ย่อยด้วย (เรียงตามชื่อ) ยกเว้นโฟลเดอร์ใน exclude เช่น โฟลเดอร์ผลลัพธ์
+    """
+    exclude = {os.path.normpath(path) for path in exclude}
+    pending = [folder_path]
+    while pending:
+        current = pending.pop()
+        subfolders = []
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if recursive and os.path.normpath(entry.path) not in exclude:
+                            subfolders.append(entry.path)
+                    elif is_image_file(entry.name) and entry.is_file():
+                        yield entry
+        except OSError:
+            if current == folder_path:
+                raise
+            # โฟลเดอร์ย่อยที่อ่านไม่ได้ (ไม่มีสิทธิ์/ถูกลบระหว่างไล่) ข้ามไป
+            continue
+        # stack: โฟลเดอร์ที่ชื่อน้อยกว่าถูกไล่ก่อน (เช่น วันที่/ชั่วโมงเรียงตามเวลา)
+        pending.extend(sorted(subfolders, reverse=True))
+
+def iter_image_paths(folder_path, recursive=False, exclude=()):
+    """Yield path ของไฟล์ภาพ (ดู iter_image_entries)"""
+    for entry in iter_image_entries(folder_path, recursive, exclude):
+        # ใช้ os.path.normpath เพื่อมาตรฐานเส้นทาง
+        yield os.path.normpath(entry.path)
+
+def collect_image_paths(folder_path, recursive=False, exclude=()):
+    """คืนรายการไฟล์ภาพในโฟลเดอร์ (ไม่รวมโฟลเดอร์ผลลัพธ์)"""
+    return list(iter_image_paths(folder_path, recursive, exclude))
+
+def list_shards(folder_path, exclude=()):
+    """แบ่งโฟลเดอร์เป็น shard สำหรับประมวลผลขนาน คืน list ของ (folder, recursive)
+
+    ไฟล์ที่อยู่ชั้นบนสุดเป็น shard หนึ่ง และโฟลเดอร์ย่อยชั้นแรกแต่ละโฟลเดอร์ (รวมโฟลเดอร์ย่อยข้างใน) เป็นอีก shard
+    """
+    exclude = {os.path.normpath(path) for path in exclude}
+    with os.scandir(folder_path) as entries:
+        subfolders = sorted(entry.path for entry in entries
+                            if entry.is_dir() and os.path.normpath(entry.path) not in exclude)
+    return [(folder_path, False)] + [(subfolder, True) for subfolder in subfolders]
+
+def mirrored_path(img_path, folder_path, target_folder, create=True):
+    """path ปลายทางใน target_folder โดยคงโฟลเดอร์ย่อยเดิมของไฟล์ (สัมพัทธ์กับ folder_path)
+
+    create=False ไม่สร้างโฟลเดอร์ย่อยปลายทาง (ให้ MoveExecutor สร้างตอนย้าย)
+    """
+    rel_dir = os.path.relpath(os.path.dirname(img_path), folder_path)
+    if rel_dir == os.curdir:
+        return os.path.join(target_folder, os.path.basename(img_path))
+    target_dir = os.path.join(target_folder, rel_dir)
+    if create:
+        os.makedirs(target_dir, exist_ok=True)
+    return os.path.join(target_dir, os.path.basename(img_path))
+
+def move_file(src, dst):
+    """ย้ายไฟล์ ใช้ os.replace ถ้าอยู่ filesystem เดียวกัน (ไม่ต้องคัดลอกข้อมูล) ไม่งั้นใช้ shutil.move
+
+    ถ้ามีไฟล์ชื่อเดียวกันที่ปลายทางอยู่แล้วจะเขียนทับ (เหมือน shutil.move เดิม ทั้ง Windows และ POSIX)
+    """
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+
+def resolve_target_paths(moves):
+    """กันชื่อไฟล์ซ้ำของการย้ายทั้งกลุ่มในครั้งเดียว
+
+    moves เป็น list ของ (src, target_path, label) คืน list ของ (src, final_path, label)
+    ตรวจเฉพาะชื่อที่จะใช้ (ไม่อ่านรายชื่อไฟล์ทั้งโฟลเดอร์ปลายทาง)
+    ชื่อที่ซ้ำจะกลายเป็น name_{label}_{n}.ext (label=None ใช้ชื่อเดิมและเขียนทับ)
+    """
+    created = set()  # โฟลเดอร์ปลายทางที่สร้าง/ตรวจแล้ว
+    reserved = set()  # path ที่จองไว้ในกลุ่มนี้แล้ว
+    counters = {}  # (โฟลเดอร์, label) -> n ถัดไป
+    resolved = []
+    for src, target_path, label in moves:
+        target_dir, filename = os.path.split(target_path)
+        if target_dir not in created:
+            os.makedirs(target_dir, exist_ok=True)
+            created.add(target_dir)
+
+        def taken(candidate):
+            path = os.path.join(target_dir, candidate)
+            return path in reserved or os.path.exists(path)
+
+        if label is not None and taken(filename):
+            name, ext = os.path.splitext(filename)
+            n = counters.get((target_dir, label), 0)
+            while taken(f"{name}_{label}_{n}{ext}"):
+                n += 1
+            counters[(target_dir, label)] = n + 1
+            filename = f"{name}_{label}_{n}{ext}"
+        final_path = os.path.join(target_dir, filename)
+        reserved.add(final_path)
+        resolved.append((src, final_path, label))
+    return resolved
+
+class MoveExecutor:
+    """ย้ายไฟล์ทีละกลุ่มใน background thread (กลุ่มที่ส่งก่อนเสร็จก่อน) เพื่อไม่ให้ UI ค้าง"""
+
+    def __init__(self, metrics=None):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self.metrics = metrics
+
+    def submit(self, moves, on_done=None, primary=False):
+        """ส่งกลุ่ม (src, target_path, label) ไปย้าย คืน Future ของ (results, not_attempted)
+
+        results: list (src, dst, label, error) ของไฟล์ที่ลองย้ายแล้ว (error=None คือสำเร็จ)
+        not_attempted: list (src, target_path, label, reason) ของไฟล์ที่ไม่ได้ลองย้ายเลย
+        on_done(results, not_attempted) ถูกเรียกใน worker thread เมื่อเสร็จ
+        primary=True: ถ้าย้ายรายการแรกไม่สำเร็จ จะไม่ย้ายรายการที่เหลือ
+        """
+        return self._executor.submit(self._run, list(moves), on_done, primary)
+
+    def _run(self, moves, on_done, primary):
+        results = []
+        not_attempted = []
+        try:
+            resolved = resolve_target_paths(moves)
+        except OSError as e:
+            resolved = []
+            not_attempted = [(src, target_path, label, f"เตรียมโฟลเดอร์ปลายทางไม่สำเร็จ: {e}")
+                             for src, target_path, label in moves]
+
+        for i, (src, dst, label) in enumerate(resolved):
+            try:
+                started = time.perf_counter()
+                move_file(src, dst)
+                if self.metrics is not None:
+                    self.metrics.record('move', time.perf_counter() - started)
+                results.append((src, dst, label, None))
+            except Exception as e:
+                results.append((src, dst, label, str(e)))
+                if primary and i == 0:
+                    not_attempted = [(src, dst, label, "ย้ายรูปต้นแบบไม่สำเร็จ")
+                                     for src, dst, label in resolved[1:]]
+                    break
+
+        if on_done is not None:
+            on_done(results, not_attempted)
+        return results, not_attempted
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+def normalize_path(path):
+    """key มาตรฐานของ path สำหรับเทียบไฟล์เดียวกัน (absolute + ตัวพิมพ์ตามระบบไฟล์)"""
+    return os.path.normcase(os.path.abspath(path))
+
+class WorkingSet:
+    """ลำดับไฟล์ที่ต้องประมวลผล ตัดไฟล์ที่ย้าย/ตัดสินใจแล้วออกได้ O(1) โดย index ของไฟล์อื่นไม่เลื่อน
+
+    ใช้แทน list ได้ (len, index, slice, iter คืนทุก path รวมที่ตัดออกแล้ว) และใช้ live()/next_live()
+    เพื่อข้ามไฟล์ที่ตัดออกแล้ว map ของ normalize_path -> index สร้างครั้งเดียวตอนเพิ่มไฟล์
+    และลบออกเมื่อไฟล์ถูกตัด การหา index ของไฟล์จึงไม่ต้องไล่ทั้งรายการ
+    forget_before() คืนหน่วยความจำของไฟล์ที่ทำเสร็จแล้ว (เช่น watch mode ที่รันนาน) โดย index ไม่เลื่อน
+    หลังจากนั้น len ยังนับไฟล์ที่ลืมไปแล้ว แต่ index/slice/iter เข้าถึงได้เฉพาะไฟล์ที่ยังจำอยู่
+    """
+
+    def __init__(self, paths=()):
+        self._paths = []
+        self._base = 0  # index ของ _paths[0] (ไฟล์ก่อนหน้านี้ถูก forget_before ไปแล้ว)
+        self._index = {}  # normalize_path(path) -> index (เฉพาะไฟล์ที่ยังไม่ถูกตัด)
+        self._removed = set()  # index ที่ตัดออกแล้ว
+        self._cursor = 0
+        self._removed_before_cursor = 0
+        for path in paths:
+            self.append(path)
+
+    def append(self, path):
+        self._index[normalize_path(path)] = len(self)
+        self._paths.append(path)
+
+    def __len__(self):
+        return self._base + len(self._paths)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self._paths[i - self._base] for i in range(*item.indices(len(self))) if i >= self._base]
+        if item < 0:
+            item += len(self)
+        if item < self._base:
+            raise IndexError(f"WorkingSet index {item} was forgotten")
+        return self._paths[item - self._base]
+
+    def __iter__(self):
+        return iter(self._paths)
+
+    def index_of(self, path):
+        """index ของ path (คืน -1 ถ้าไม่อยู่ในรายการหรือถูกตัดไปแล้ว)"""
+        return self._index.get(normalize_path(path), -1)
+
+    def discard(self, path):
+        """ตัดไฟล์ออก (ย้ายหรือตัดสินใจแล้ว) คืน True ถ้าเพิ่งถูกตัดครั้งนี้"""
+        i = self._index.pop(normalize_path(path), None)
+        if i is None:
+            return False
+        self._removed.add(i)
+        if i < self._cursor:
+            self._removed_before_cursor += 1
+        return True
+
+    def is_live(self, path):
+        return normalize_path(path) in self._index
+
+    def live(self, start, end):
+        """path ที่ยังไม่ถูกตัดในช่วง index [start, end)"""
+        removed = self._removed
+        end = min(end, len(self))
+        return [self._paths[i - self._base] for i in range(max(start, self._base), end) if i not in removed]
+
+    def next_live(self, i):
+        """index แรกตั้งแต่ i ที่ยังไม่ถูกตัด (หรือ len ถ้าไม่มี)"""
+        i = max(i, self._base)
+        while i < len(self) and i in self._removed:
+            i += 1
+        return i
+
+    def remaining(self, i):
+        """จำนวนไฟล์ที่ยังไม่ถูกตัดตั้งแต่ index i (ถูกเมื่อ i เพิ่มขึ้นเรื่อยๆ)"""
+        if i < self._cursor or self._cursor < self._base:
+            self._cursor = self._base
+            self._removed_before_cursor = 0
+        removed = self._removed
+        while self._cursor < i:
+            if self._cursor in removed:
+                self._removed_before_cursor += 1
+            self._cursor += 1
+        return len(self) - max(i, self._base) - (len(removed) - self._removed_before_cursor)
+
+    def forget_before(self, i):
+        """ลืม path ที่ index < i (ทำเสร็จแล้ว) เพื่อไม่ให้หน่วยความจำโตตามเวลาที่รัน"""
+        count = min(i, len(self)) - self._base
+        if count <= 0:
+            return
+        for offset, path in enumerate(self._paths[:count]):
+            key = normalize_path(path)
+            # ไฟล์ชื่อเดิมที่ถูกเพิ่มเข้ามาใหม่ภายหลังมี index ใหม่ ต้องไม่ลบออก
+            if self._index.get(key) == self._base + offset:
+                del self._index[key]
+        del self._paths[:count]
+        self._base += count
+        self._removed = {r for r in self._removed if r >= self._base}
+
+class FolderScanner:
+    """ส่งรายการไฟล์ภาพเข้า pipeline ระหว่างที่ยังไล่โฟลเดอร์ไม่เสร็จ และ (ถ้าใช้ watch) เฝ้าดูไฟล์ใหม่
+
+    skip คือชุดของ path สัมพัทธ์กับโฟลเดอร์ที่ไม่ต้องส่งต่อ (เช่น ไฟล์ที่ทำไปแล้วใน session ก่อน)
+    recursive / exclude ส่งต่อให้ iter_image_entries
+    """
+
+    def __init__(self, folder_path, interval=2.0, skip=None, recursive=False, exclude=()):
+        self.folder_path = folder_path
+        self.interval = interval
+        self.skip = skip or set()
+        self.recursive = recursive
+        self.exclude = tuple(exclude)
+
+    def _entries(self):
+        return iter_image_entries(self.folder_path, self.recursive, self.exclude)
+
+    def _skipped(self, img_path):
+        return bool(self.skip) and os.path.relpath(img_path, self.folder_path) in self.skip
+
+    def scan(self):
+        """Yield ไฟล์ภาพที่มีอยู่ตอนนี้ครั้งเดียว"""
+        for img_path in iter_image_paths(self.folder_path, self.recursive, self.exclude):
+            if not self._skipped(img_path):
+                yield img_path
+
+    def watch(self, should_continue):
+        """Yield ไฟล์ที่มีอยู่ แล้วเฝ้าดูไฟล์ใหม่ต่อจนกว่า should_continue() จะเป็น False
+
+        ไฟล์ใหม่จะถูกส่งต่อเมื่อขนาดและเวลาแก้ไขไม่เปลี่ยนระหว่างสองรอบ (คัดลอกเสร็จแล้ว)
+        """
+        seen = set()
+        for img_path in iter_image_paths(self.folder_path, self.recursive, self.exclude):
+            seen.add(img_path)
+            if not self._skipped(img_path):
+                yield img_path
+
+        pending = {}  # path -> (size, mtime_ns) ที่เห็นในรอบก่อน
+        while self._wait(should_continue):
+            try:
+                current = {os.path.normpath(entry.path): entry for entry in self._entries()}
+            except OSError:
+                continue
+
+            # ไฟล์ที่ถูกย้ายออกไปแล้ว ถ้ามีไฟล์ชื่อเดิมวางเข้ามาใหม่ต้องทำอีกรอบ
+            # (seen จึงไม่เกินจำนวนไฟล์ที่อยู่ในโฟลเดอร์ตอนนี้ ไม่โตตามเวลาที่เฝ้าดู)
+            seen &= current.keys()
+            pending = {path: signature for path, signature in pending.items() if path in current}
+            for img_path, entry in current.items():
+                if img_path in seen:
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                signature = (st.st_size, st.st_mtime_ns)
+                if pending.get(img_path) == signature:
+                    del pending[img_path]
+                    seen.add(img_path)
+                    yield img_path
+                else:
+                    pending[img_path] = signature
+
+    def _wait(self, should_continue):
+        deadline = time.monotonic() + self.interval
+        while time.monotonic() < deadline:
+            if not should_continue():
+                return False
+            time.sleep(0.1)
+        return should_continue()
+
+def is_target_class(class_name, keywords=TARGET_CLASS_KEYWORDS):
+    """ตรวจว่าคลาสที่ทำนายเป็นคลาสเป้าหมาย (รถ/คน/ยานพาหนะ) หรือไม่"""
+    return any(keyword.lower() in class_name.lower() for keyword in keywords)
+
+def auto_destination(mode, class_name, confidence, keywords=TARGET_CLASS_KEYWORDS):
+    """กฎของโหมดอัตโนมัติ: คืนชื่อโฟลเดอร์ปลายทาง หรือ None ถ้าข้าม"""
+    target = is_target_class(class_name, keywords)
+    if mode == "not_car_auto":
+        # ถ้าเจอรถ → Skip, ถ้าไม่เจอรถ → ย้ายไป not_car
+        return None if target else 'not_car'
+    if mode == "car_auto":
+        # ถ้าเจอรถและ confidence = 1.0 → ย้ายไป car_auto, นอกนั้น Skip
+        return 'car_auto' if target and confidence > CAR_AUTO_MIN_CONFIDENCE else None
+    return None
+
+def apply_auto_rule(mode, img_path, class_name, confidence, target_folders, stats,
+                    keywords=TARGET_CLASS_KEYWORDS, folder_path=None):
+    """ย้ายไฟล์ตามกฎโหมดอัตโนมัติและอัปเดต stats คืนค่า path ปลายทาง หรือ None ถ้าข้าม
+
+    ถ้าให้ folder_path ไฟล์ในโฟลเดอร์ย่อยจะถูกย้ายไปโฟลเดอร์ย่อยชื่อเดียวกันในโฟลเดอร์ผลลัพธ์
+    """
+    destination = auto_destination(mode, class_name, confidence, keywords)
+    target_path = None
+    if destination:
+        if folder_path:
+            target_path = mirrored_path(img_path, folder_path, target_folders[destination])
+        else:
+            target_path = os.path.join(target_folders[destination], os.path.basename(img_path))
+        move_file(img_path, target_path)
+        stats['auto_not_car'] += 1  # ใช้ตัวแปรเดิมทั้งสองโหมด
+    else:
+        stats['skipped'] += 1
+    stats['processed'] += 1
+    return target_path
+
+def new_stats(total=0):
+    """สร้าง dict สถิติเริ่มต้น"""
+    return {
+        'total': total,
+        'processed': 0,
+        'car': 0,
+        'not_car': 0,
+        'person': 0,
+        'auto_not_car': 0,
+        'similar_moved': 0,
+        'skipped': 0,
+        'move_failed': 0
+    }
+
+# ขั้นของ pipeline ที่จับเวลา (เรียงตามลำดับการทำงาน)
+PIPELINE_STAGES = ('scan', 'decode', 'preprocess', 'inference', 'features', 'similarity', 'move', 'render')
+
+class PipelineMetrics:
+    """เวลาที่ใช้ในแต่ละขั้นของ pipeline เพื่อดูว่าเครื่องช้าเพราะดิสก์ CPU หรือโมเดล
+
+    ขั้นที่ทำเป็น batch บันทึกเวลาเฉลี่ยต่อรูปของ batch นั้นเป็นหนึ่งตัวอย่าง
+    percentile คิดจากตัวอย่างล่าสุดไม่เกิน max_samples ต่อขั้น (จำนวนและเวลารวมนับทั้งหมด)
+    """
+    FORMAT_MAX_AGE = 1.0  # วินาที: format_summary คำนวณ percentile ใหม่ไม่ถี่กว่านี้
+
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._samples = {stage: deque(maxlen=self.max_samples) for stage in PIPELINE_STAGES}
+            self._counts = dict.fromkeys(PIPELINE_STAGES, 0)
+            self._totals = dict.fromkeys(PIPELINE_STAGES, 0.0)
+            self._images = 0
+            self._started = time.monotonic()
+            self._formatted = None  # (เวลาที่คำนวณ, ข้อความ) ของ format_summary
+
+    def record(self, stage, seconds, count=1):
+        """บันทึกเวลาของ count รูปที่ทำพร้อมกันในขั้น stage"""
+        if count <= 0:
+            return
+        with self._lock:
+            self._samples[stage].append(seconds / count)
+            self._counts[stage] += count
+            self._totals[stage] += seconds
+
+    @contextlib.contextmanager
+    def measure(self, stage, count=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, count)
+
+    def image_done(self, count=1):
+        with self._lock:
+            self._images += count
+
+    def summary(self):
+        """dict สรุปต่อขั้น (ms ต่อรูป: mean/p50/p90/p99/max) และจำนวนรูปต่อวินาที"""
+        with self._lock:
+            samples = {stage: np.array(values) for stage, values in self._samples.items()}
+            counts = dict(self._counts)
+            totals = dict(self._totals)
+            images = self._images
+            elapsed = time.monotonic() - self._started
+
+        stages = {}
+        for stage in PIPELINE_STAGES:
+            if counts[stage] == 0:
+                continue
+            p50, p90, p99 = np.percentile(samples[stage], [50, 90, 99]) * 1000
+            stages[stage] = {
+                'count': counts[stage],
+                'total_sec': round(totals[stage], 3),
+                'mean_ms': round(totals[stage] / counts[stage] * 1000, 3),
+                'p50_ms': round(float(p50), 3),
+                'p90_ms': round(float(p90), 3),
+                'p99_ms': round(float(p99), 3),
+                'max_ms': round(float(samples[stage].max()) * 1000, 3),
+            }
+        return {
+            'elapsed_sec': round(elapsed, 3),
+            'images': images,
+            'images_per_sec': round(images / elapsed, 2) if elapsed > 0 else None,
+            'stages': stages,
+        }
+
+    def format_summary(self):
+        """ข้อความสั้นๆ สำหรับแผงสถิติ (ใช้ผลเดิมถ้าเพิ่งคำนวณไม่ถึง FORMAT_MAX_AGE วินาที)"""
+        now = time.monotonic()
+        formatted = self._formatted
+        if formatted is not None and now - formatted[0] < self.FORMAT_MAX_AGE:
+            return formatted[1]
+        text = self._format(self.summary())
+        self._formatted = (now, text)
+        return text
+
+    @staticmethod
+    def _format(summary):
+        parts = [f"{stage} {stats['p50_ms']:.1f}/{stats['p90_ms']:.1f}"
+                 for stage, stats in summary['stages'].items()]
+        return (f"{summary['images_per_sec'] or 0:.1f} รูป/วินาที — เวลาต่อรูป p50/p90 (ms): "
+                + (" | ".join(parts) or "-"))
+
+    def export(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, ensure_ascii=False, indent=2)
+
+class ModelManager:
+    """โหลดโมเดลครั้งเดียวต่อ process (warm-up แล้ว) และใช้ร่วมกันทุกโหมด/ทุกการรัน"""
+    _models = {}
+    _lock = threading.Lock()
+    # ให้มีการ inference ได้ทีละครั้ง (งานล่วงหน้ากับงานหลักใช้โมเดลตัวเดียวกัน)
+    inference_lock = threading.Lock()
+
+    @staticmethod
+    def select_device():
+        """เลือก device อัตโนมัติ: CUDA → Apple MPS → CPU"""
+        import torch  # import เมื่อใช้ (worker process ของ ParallelFeatureExtractor ไม่ต้องโหลด)
+        if torch.cuda.is_available():
+            return 0
+        mps = getattr(torch.backends, 'mps', None)
+        if mps is not None and mps.is_available():
+            return 'mps'
+        return 'cpu'
+
+    _checksums = {}
+
+    @classmethod
+    def checksum(cls, model_path):
+        """checksum ของไฟล์น้ำหนักโมเดล (ใช้เป็น key ของ PredictionCache)"""
+        key = os.path.abspath(model_path)
+        if key not in cls._checksums:
+            cls._checksums[key] = file_content_hash(model_path)
+        return cls._checksums[key]
+
+    @classmethod
+    def is_loaded(cls, model_path):
+        return os.path.abspath(model_path) in cls._models
+
+    @classmethod
+    def get(cls, model_path='best-cls-v2.pt'):
+        """คืนโมเดลที่โหลดแล้ว (โหลดและ warm-up ในครั้งแรก)"""
+        key = os.path.abspath(model_path)
+        with cls._lock:
+            if key not in cls._models:
+                from ultralytics import YOLO
+                model_device = cls.select_device()
+                model = YOLO(model_path).to(model_device)
+                cls.warm_up(model, model_device)
+                cls._models[key] = model
+            return cls._models[key]
+
+    @staticmethod
+    def warm_up(model, model_device, image_size=224):
+        """forward pass แรกด้วยรูปว่าง เพื่อสร้าง predictor และ CUDA kernel ไว้ล่วงหน้า"""
+        dummy = np.zeros((image_size, image_size, 3), dtype=np.uint8)
+        model(dummy, device=model_device, verbose=False)
+
+class ImagePrefetcher:
+    """อ่านและ decode ไฟล์ล่วงหน้าด้วย background thread ลงใน queue ที่มีขอบเขต
+
+    producer จะหยุดรอเมื่อ queue เต็ม (backpressure) หน่วยความจำจึงไม่เกิน
+    depth + workers รูป ไม่ว่าโฟลเดอร์จะใหญ่แค่ไหน
+    """
+    _DONE = object()
+
+    def __init__(self, img_paths, decode, depth=64, workers=4):
+        self.img_paths = img_paths
+        self.decode = decode
+        self.depth = max(1, int(depth))
+        self.workers = max(1, int(workers))
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._stopped = threading.Event()
+        self._source_idle = threading.Event()  # producer กำลังรอไฟล์ถัดไปจาก img_paths
+        self._executor = None
+        self._producer = None
+
+    def _decode_safe(self, img_path):
+        try:
+            return self.decode(img_path)
+        except Exception:
+            return None
+
+    def _produce(self):
+        try:
+            img_paths = iter(self.img_paths)
+            while True:
+                self._source_idle.set()
+                try:
+                    img_path = next(img_paths, self._DONE)
+                finally:
+                    self._source_idle.clear()
+                if img_path is self._DONE:
+                    break
+                if self._stopped.is_set():
+                    # ผู้ใช้หยุดก่อนขณะรอไฟล์ถัดไป executor อาจถูกปิดไปแล้ว
+                    return
+                try:
+                    future = self._executor.submit(self._decode_safe, img_path)
+                except RuntimeError:
+                    # close() ปิด executor ระหว่างตรวจ _stopped กับ submit
+                    return
+                # put แบบมี timeout เพื่อให้ตรวจ _stopped ได้ขณะรอ queue ว่าง
+                while not self._stopped.is_set():
+                    try:
+                        self._queue.put((img_path, future), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if self._stopped.is_set():
+                    return
+        finally:
+            if self._stopped.is_set():
+                try:
+                    self._queue.put_nowait(self._DONE)
+                except queue.Full:
+                    pass
+            else:
+                self._queue.put(self._DONE)
+
+    def __iter__(self):
+        """Yield (img_path, image) ตามลำดับ (image เป็น None ถ้าอ่านไม่ได้)"""
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._producer = threading.Thread(target=self._produce, daemon=True)
+        self._producer.start()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is self._DONE:
+                    return
+                img_path, future = item
+                yield img_path, future.result()
+        finally:
+            self.close()
+
+    def starved(self):
+        """True ถ้าไม่มีรูปรออยู่และ producer กำลังรอไฟล์ใหม่จากต้นทาง (เช่น watch mode)"""
+        return self._queue.empty() and self._source_idle.is_set()
+
+    def close(self):
+        """หยุด producer และคืน thread (เรียกได้หลายครั้ง)"""
+        self._stopped.set()
+        # ดึงของที่ค้างใน queue ออกเพื่อให้ producer ที่รออยู่จบได้
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+# โฟลเดอร์ cache ที่ใช้ร่วมกันทุกโฟลเดอร์รูปภาพ
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "classify_car")
+
+def content_hash(data):
+    """hash ของเนื้อหาไฟล์ (ไม่ขึ้นกับชื่อหรือตำแหน่งไฟล์)"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def file_content_hash(file_path, chunk_size=1 << 20):
+    """content_hash ของไฟล์ โดยอ่านทีละก้อน"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class PredictionCache:
+    """Cache ผลทำนายบน SQLite: (content hash, model checksum) → (top1 class, top1 confidence, probs)
+
+    จำกัดจำนวนรายการไว้ที่ max_entries โดยลบรายการที่ไม่ได้ใช้นานที่สุดออกก่อน
+    """
+    FILENAME = 'predictions.sqlite'
+    COMMIT_EVERY = 200
+
+    def __init__(self, db_path, model_checksum, max_entries=2_000_000):
+        self.db_path = db_path
+        self.model_checksum = model_checksum
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._pending = 0
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS predictions ("
+            " content_hash TEXT, model TEXT, class_name TEXT, confidence REAL, probs BLOB,"
+            " last_used REAL, PRIMARY KEY (content_hash, model))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)")
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+
+    @classmethod
+    def open_default(cls, model_checksum, **kwargs):
+        return cls(os.path.join(CACHE_DIR, cls.FILENAME), model_checksum, **kwargs)
+
+    def get(self, key):
+        """คืน (class_name, confidence) ที่เคยทำนายด้วยโมเดลเดียวกัน หรือ None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT class_name, confidence FROM predictions WHERE content_hash = ? AND model = ?",
+                (key, self.model_checksum)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE predictions SET last_used = ? WHERE content_hash = ? AND model = ?",
+                (time.time(), key, self.model_checksum)
+            )
+            self._mark_dirty()
+        return row[0], row[1]
+
+    def get_probs(self, key):
+        """คืน probability ของทุกคลาส (ถ้าเก็บไว้) เป็น float32 array"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT probs FROM predictions WHERE content_hash = ? AND model = ?",
+                (key, self.model_checksum)
+            ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float16).astype(np.float32)
+
+    def put(self, key, class_name, confidence, probs=None):
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?)",
+                (key, self.model_checksum, class_name, confidence,
+                 np.asarray(probs, dtype=np.float16).tobytes() if probs is not None else None,
+                 time.time())
+            )
+            self._count += cursor.rowcount
+            if self._count > self.max_entries:
+                self._evict()
+            self._mark_dirty()
+
+    def _evict(self):
+        # ลบให้เหลือ 90% ของขนาดสูงสุด จะได้ไม่ต้องลบทุกครั้งที่เพิ่ม
+        self._count = self._conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+        excess = self._count - int(self.max_entries * 0.9)
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM predictions WHERE rowid IN "
+                "(SELECT rowid FROM predictions ORDER BY last_used LIMIT ?)", (excess,)
+            )
+            self._count -= excess
+
+    def _mark_dirty(self):
+        self._pending += 1
+        if self._pending >= self.COMMIT_EVERY:
+            self._conn.commit()
+            self._pending = 0
+
+    def flush(self):
+        with self._lock:
+            self._conn.commit()
+            self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+class ThumbnailCache:
+    """Cache thumbnail: memory LRU + ไฟล์ JPEG เล็กๆ บนดิสก์ (จำกัดจำนวนไฟล์ ลบที่ไม่ได้ใช้นานที่สุดก่อน)
+
+    key มาจาก (ชื่อไฟล์, ขนาดไฟล์, mtime) ของ os.stat รวมกับ hash ของต้นและท้ายไฟล์ (SAMPLE_BYTES)
+    ไฟล์ต่างกันที่บังเอิญชื่อ ขนาด และ mtime ตรงกัน (เช่น copy แบบคง timestamp) จึงไม่ชนกัน
+    การย้ายไฟล์ (os.replace / shutil.move) คงชื่อ ขนาด mtime และเนื้อไฟล์ไว้ รูปที่ย้ายแล้วจึงยังใช้ thumbnail เดิมได้
+    ส่วนรูปที่ถูกเปลี่ยนชื่อตอนย้าย (ชื่อซ้ำ) จะ decode ใหม่
+    """
+    DIRNAME = 'thumbnails'
+    JPEG_QUALITY = 85
+    SAMPLE_BYTES = 64 * 1024
+
+    def __init__(self, cache_dir, max_memory=512, max_disk_entries=50_000, log=None):
+        self.cache_dir = cache_dir
+        self.max_memory = max_memory
+        self.max_disk_entries = max_disk_entries
+        self.log = log or (lambda message, level="normal": None)
+        self._memory = OrderedDict()  # (key, size) -> PIL Image
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._disk_count = sum(1 for _ in self._disk_entries())
+
+    @classmethod
+    def open_default(cls, **kwargs):
+        return cls(os.path.join(CACHE_DIR, cls.DIRNAME), **kwargs)
+
+    @classmethod
+    def key(cls, img_path):
+        digest = hashlib.blake2b(digest_size=16)
+        with open(img_path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            digest.update(f"{os.path.basename(img_path)}|{st.st_size}|{st.st_mtime_ns}|".encode('utf-8'))
+            digest.update(f.read(cls.SAMPLE_BYTES))
+            if st.st_size > 2 * cls.SAMPLE_BYTES:
+                f.seek(-cls.SAMPLE_BYTES, os.SEEK_END)
+            digest.update(f.read(cls.SAMPLE_BYTES))
+        return digest.hexdigest()
+
+    def disk_path(self, key, size):
+        return os.path.join(self.cache_dir, key[:2], f"{key}_{size[0]}x{size[1]}.jpg")
+
+    def get(self, img_path, size):
+        """คืน thumbnail (PIL Image) จาก memory → ดิสก์ → decode ไฟล์ต้นฉบับ ตามลำดับ"""
+        size = tuple(size)
+        key = self.key(img_path)
+        memory_key = (key, size)
+        with self._lock:
+            image = self._memory.get(memory_key)
+            if image is not None:
+                self._memory.move_to_end(memory_key)
+                return image
+
+        disk_path = self.disk_path(key, size)
+        try:
+            image = Image.open(disk_path)
+            image.load()
+            os.utime(disk_path)  # mtime = เวลาที่ใช้ล่าสุด (ใช้ตอนลบไฟล์เก่า)
+        except OSError:
+            image = load_thumbnail(img_path, size)
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            self._write(disk_path, image)
+
+        with self._lock:
+            self._memory[memory_key] = image
+            self._memory.move_to_end(memory_key)
+            while len(self._memory) > self.max_memory:
+                self._memory.popitem(last=False)
+        return image
+
+    def _write(self, disk_path, image):
+        # เขียนไฟล์ชั่วคราวแล้ว rename เพื่อไม่ให้ thread อื่นอ่านเจอไฟล์ครึ่งๆ
+        tmp_path = f"{disk_path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+            image.save(tmp_path, 'JPEG', quality=self.JPEG_QUALITY)
+            os.replace(tmp_path, disk_path)
+        except OSError as e:
+            self.log(f"เขียน thumbnail cache ไม่ได้: {e}", "warning")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            self._disk_count += 1
+            over_limit = self._disk_count > self.max_disk_entries
+        if over_limit:
+            self._evict()
+
+    def _disk_entries(self):
+        for subdir in os.scandir(self.cache_dir):
+            if subdir.is_dir():
+                for entry in os.scandir(subdir.path):
+                    if entry.name.endswith('.jpg'):
+                        yield entry
+
+    def _evict(self):
+        # ลบให้เหลือ 90% ของขนาดสูงสุด จะได้ไม่ต้องลบทุกครั้งที่เพิ่ม (thread เดียวลบในแต่ละครั้ง)
+        if not self._evict_lock.acquire(blocking=False):
+            return
+        try:
+            entries = []
+            for entry in self._disk_entries():
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    pass
+            entries.sort()
+            excess = len(entries) - int(self.max_disk_entries * 0.9)
+            removed = 0
+            for _, path in entries[:max(0, excess)]:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+            with self._lock:
+                self._disk_count = len(entries) - removed
+        finally:
+            self._evict_lock.release()
+
+class BatchClassifier:
+    """รันโมเดล classification ทีละ batch แทนการเรียกทีละไฟล์
+
+    การ decode ไฟล์ถัดไปทำล่วงหน้าใน ImagePrefetcher ขณะที่ batch ปัจจุบันอยู่ในโมเดล
+    ถ้ามี PredictionCache รูปที่เคยทำนายด้วยโมเดลเดียวกันจะไม่ถูก decode หรือส่งเข้าโมเดลอีก
+    """
+
+    def __init__(self, model, batch_size=32, prefetch_depth=64, decode_workers=4,
+                 cache=None, store_probs=False, metrics=None):
+        self.model = model
+        self.batch_size = max(1, int(batch_size))
+        self.prefetch_depth = max(self.batch_size, int(prefetch_depth))
+        self.decode_workers = decode_workers
+        self.cache = cache
+        self.store_probs = store_probs
+        self.metrics = metrics
+
+    def decode(self, img_path):
+        """อ่านรูปเป็น BGR array (คืน None ถ้าอ่านไม่ได้)"""
+        return cv2.imread(img_path)
+
+    def load(self, img_path):
+        """อ่านไฟล์สำหรับ prefetcher คืน (content_hash, image, cached_prediction)"""
+        if self.metrics is None:
+            return self._load(img_path)
+        with self.metrics.measure('decode'):
+            return self._load(img_path)
+
+    def _load(self, img_path):
+        if self.cache is None:
+            return None, self.decode(img_path), None
+
+        with open(img_path, 'rb') as f:
+            data = f.read()
+        key = content_hash(data)
+        cached = self.cache.get(key)
+        if cached is not None:
+            # เคยทำนายแล้ว ไม่ต้อง decode
+            return key, None, cached
+        return key, cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR), None
+
+    def predict(self, images):
+        """ส่งรูปหลายรูปเข้าโมเดลครั้งเดียว คืน list ของ (class_name, confidence, probs)"""
+        with ModelManager.inference_lock:
+            started = time.perf_counter()
+            results = self.model(images, verbose=False)
+            elapsed = time.perf_counter() - started
+        if self.metrics is not None and results:
+            # Ultralytics แยกเวลา preprocess ไว้ใน result.speed (ms ต่อรูป)
+            speed = getattr(results[0], 'speed', None) or {}
+            preprocess = 0.0
+            if speed.get('preprocess') is not None:
+                preprocess = min(elapsed, speed['preprocess'] / 1000 * len(images))
+                self.metrics.record('preprocess', preprocess, len(images))
+            self.metrics.record('inference', elapsed - preprocess, len(images))
+        predictions = []
+        for result in results:
+            class_id = result.probs.top1
+            probs = result.probs.data.cpu().numpy() if self.store_probs else None
+            predictions.append((result.names[class_id], result.probs.top1conf.item(), probs))
+        return predictions
+
+    def classify(self, img_paths):
+        """Yield (img_path, class_name, confidence, error) ตามลำดับของ img_paths"""
+        prefetcher = ImagePrefetcher(img_paths, self.load, self.prefetch_depth, self.decode_workers)
+        chunk = []
+        for item in prefetcher:
+            chunk.append(item)
+            # ไม่รอให้ batch เต็มถ้าต้นทางยังไม่มีไฟล์ใหม่ (ไฟล์ถูกส่งเข้ามาทีละน้อย)
+            if len(chunk) >= self.batch_size or prefetcher.starved():
+                yield from self._classify_chunk(chunk)
+                chunk = []
+        if chunk:
+            yield from self._classify_chunk(chunk)
+
+    def classify_one(self, img_path):
+        """จำแนกไฟล์เดียวโดยไม่สร้าง prefetcher คืน (class_name, confidence, error)"""
+        try:
+            loaded = self.load(img_path)
+        except Exception:
+            loaded = None
+        _, class_name, confidence, error = next(self._classify_chunk([(img_path, loaded)]))
+        return class_name, confidence, error
+
+    def _classify_chunk(self, chunk):
+        unreadable = "ไม่สามารถอ่านไฟล์ภาพได้"
+        images = [(img_path, loaded) for img_path, loaded in chunk
+                  if loaded is not None and loaded[1] is not None]
+
+        predictions = {}
+        error = unreadable
+        if images:
+            try:
+                batch = self.predict([loaded[1] for _, loaded in images])
+                for (img_path, loaded), (class_name, confidence, probs) in zip(images, batch):
+                    predictions[img_path] = (class_name, confidence)
+                    if self.cache is not None:
+                        self.cache.put(loaded[0], class_name, confidence, probs)
+            except Exception as e:
+                error = str(e)
+
+        if self.metrics is not None:
+            self.metrics.image_done(len(chunk))
+        for img_path, loaded in chunk:
+            if loaded is not None and loaded[2] is not None:
+                class_name, confidence = loaded[2]
+                yield img_path, class_name, confidence, None
+            elif img_path in predictions:
+                class_name, confidence = predictions[img_path]
+                yield img_path, class_name, confidence, None
+            elif loaded is None or loaded[1] is None:
+                yield img_path, None, None, unreadable
+            else:
+                yield img_path, None, None, error
+
+REFERENCE_PREVIEW_SIZE = (400, 300)  # รูปต้นแบบในหน้าต่างตัดสินใจ
+
+def load_thumbnail(img_path, size):
+    """เปิดรูปเป็น thumbnail โดยให้ JPEG decode ที่ความละเอียดต่ำ (draft mode)"""
+    img = Image.open(img_path)
+    img.draft(None, size)  # JPEG: เลือก scale 1/2, 1/4, 1/8 ที่ยังใหญ่กว่า size
+    img.thumbnail(size)
+    return img
+
+def default_feature_workers():
+    """จำนวน worker process เริ่มต้น (ไม่เกิน ParallelFeatureExtractor.MAX_DEFAULT_WORKERS)"""
+    return min(os.cpu_count() or 1, ParallelFeatureExtractor.MAX_DEFAULT_WORKERS)
+
+class ParallelFeatureExtractor:
+    """กระจายการ decode และคำนวณ feature ไปหลาย process แล้วคืนผลตามลำดับไฟล์"""
+
+    MAX_DEFAULT_WORKERS = 8
+
+    def __init__(self, workers=None):
+        self.workers = max(1, int(workers or default_feature_workers()))
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn ทุกระบบ: ไม่ fork process ที่มี Tk, CUDA และ thread ทำงานอยู่
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'),
+                                                     initializer=init_feature_worker)
+            return self._executor
+
+    def extract(self, img_paths, with_orb=True):
+        """Yield (img_path, features) ตามลำดับของ img_paths (features เป็น None ถ้าอ่านไม่ได้)"""
+        if self.workers == 1 or len(img_paths) < 2:
+            for img_path in img_paths:
+                yield img_path, extract_features_safe(img_path, with_orb)
+            return
+
+        # ส่งงานทีละก้อนเพื่อไม่ให้มีผลลัพธ์ค้างในหน่วยความจำมากเกินไป
+        chunksize = max(1, min(16, len(img_paths) // (self.workers * 4)))
+        block_size = self.workers * chunksize * 4
+        pool = self._pool()
+        for start in range(0, len(img_paths), block_size):
+            block = img_paths[start:start + block_size]
+            for img_path, features in zip(block, pool.map(extract_features_safe, block, repeat(with_orb, len(block)), chunksize=chunksize)):
+                yield img_path, features
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+# น้ำหนักของแต่ละ metric (ถ้าไม่มี ORB match ใช้ชุด NO_ORB)
+SIMILARITY_WEIGHTS = {'hist': 0.4, 'avg_hash': 0.2, 'd_hash': 0.3, 'orb': 0.1}
+SIMILARITY_WEIGHTS_NO_ORB = {'hist': 0.5, 'avg_hash': 0.2, 'd_hash': 0.3}
+
+# จำนวนบิตที่เป็น 1 ของทุกค่า byte (ใช้นับ popcount ของ uint64)
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def hamming_distance(a, b):
+    """จำนวนบิตที่ต่างกันของ hash 64 บิตสองค่า"""
+    return bin(a ^ b).count('1')
+
+def popcount64(values):
+    """นับจำนวนบิตที่เป็น 1 ของ uint64 array"""
+    values = np.ascontiguousarray(values, dtype=np.uint64)
+    return _POPCOUNT_TABLE[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+def hist_correlation(ref_hist, hists):
+    """HISTCMP_CORREL ของ ref กับทุกแถวของ hists ในครั้งเดียว (ผลเท่ากับ cv2.compareHist)"""
+    ref_centered = ref_hist.astype(np.float64) - ref_hist.mean()
+    centered = hists.astype(np.float64) - hists.mean(axis=1, keepdims=True)
+    numerator = centered @ ref_centered
+    denominator = np.sqrt((ref_centered @ ref_centered) * np.einsum('ij,ij->i', centered, centered))
+    # OpenCV คืนค่า 1 เมื่อ variance เป็นศูนย์
+    safe = denominator > np.finfo(np.float64).eps
+    return np.where(safe, numerator / np.where(safe, denominator, 1.0), 1.0)
+
+def stack_features(features_list):
+    """รวม feature หลายรูปเป็น matrix สำหรับคำนวณแบบ vectorized"""
+    return {
+        'hist': np.stack([f['hist'] for f in features_list]),
+        'avg_hash': np.array([f['avg_hash'] for f in features_list], dtype=np.uint64),
+        'd_hash': np.array([f['d_hash'] for f in features_list], dtype=np.uint64),
+    }
+
+def combine_similarity(hist_similarity, avg_hash_similarity, d_hash_similarity, feature_similarity):
+    """รวมคะแนนด้วยน้ำหนัก 0.4/0.2/0.3/0.1 (หรือ 0.5/0.2/0.3 ถ้าไม่มี ORB match)"""
+    with_orb = (hist_similarity * SIMILARITY_WEIGHTS['hist'] +
+                avg_hash_similarity * SIMILARITY_WEIGHTS['avg_hash'] +
+                d_hash_similarity * SIMILARITY_WEIGHTS['d_hash'] +
+                feature_similarity * SIMILARITY_WEIGHTS['orb'])
+    without_orb = (hist_similarity * SIMILARITY_WEIGHTS_NO_ORB['hist'] +
+                   avg_hash_similarity * SIMILARITY_WEIGHTS_NO_ORB['avg_hash'] +
+                   d_hash_similarity * SIMILARITY_WEIGHTS_NO_ORB['d_hash'])
+    return np.where(feature_similarity > 0, with_orb, without_orb)
+
+def cheap_similarity(ref, candidates):
+    """metric ที่ไม่ต้องใช้ ORB: (histogram, average hash, difference hash) เป็น array"""
+    ref_avg_hash = np.uint64(ref['avg_hash'])
+    ref_d_hash = np.uint64(ref['d_hash'])
+
+    hist_similarity = np.maximum(0, hist_correlation(ref['hist'], candidates['hist']))
+    avg_hash_similarity = 1.0 - popcount64(candidates['avg_hash'] ^ ref_avg_hash) / 64.0
+    d_hash_similarity = 1.0 - popcount64(candidates['d_hash'] ^ ref_d_hash) / 64.0
+    return hist_similarity, avg_hash_similarity, d_hash_similarity
+
+def score_similarity(ref, candidates, feature_similarity):
+    """คะแนนความคล้ายของ ref กับ candidates ทั้งหมด (ผลจาก stack_features) คืน array
+
+    feature_similarity คือคะแนน ORB ของแต่ละ candidate (จาก OrbMatcher.batch_similarity)
+    """
+    feature_similarity = np.asarray(feature_similarity, dtype=np.float64)
+    return combine_similarity(*cheap_similarity(ref, candidates), feature_similarity)
+
+def score_similarity_cascade(ref, candidates, threshold, orb_similarity):
+    """คะแนนความคล้ายแบบ cascade: คำนวณ metric ถูกๆ ก่อน แล้วทำ ORB เฉพาะรูปที่ยังมีโอกาสผ่าน
+
+    orb_similarity(indices) คืนคะแนน ORB ของ candidate ตาม indices
+    รูปที่ถูกตัดทิ้งจะได้คะแนนแบบไม่มี ORB ซึ่งต่ำกว่า threshold อยู่แล้ว
+    การตัดสินคล้าย/ไม่คล้ายจึงเหมือนกับ score_similarity ทุกประการ
+    คืนค่า (scores, จำนวนรูปที่ต้องทำ ORB)
+    """
+    hist_similarity, avg_hash_similarity, d_hash_similarity = cheap_similarity(ref, candidates)
+    count = len(hist_similarity)
+
+    # คะแนนสูงสุดที่เป็นไปได้: ORB ได้เต็ม 1 หรือไม่มี ORB match เลย (เลือกกรณีที่มากกว่า)
+    best_case = np.maximum(
+        combine_similarity(hist_similarity, avg_hash_similarity, d_hash_similarity, np.ones(count)),
+        combine_similarity(hist_similarity, avg_hash_similarity, d_hash_similarity, np.zeros(count)),
+    )
+    survivors = np.flatnonzero(best_case >= threshold)
+
+    feature_similarity = np.zeros(count, dtype=np.float64)
+    if survivors.size:
+        feature_similarity[survivors] = orb_similarity(survivors)
+
+    scores = combine_similarity(hist_similarity, avg_hash_similarity, d_hash_similarity, feature_similarity)
+    return scores, int(survivors.size)
+
+class OrbMatcher:
+    """จับคู่ ORB descriptor ด้วย BFMatcher ตัวเดียว พร้อม cache descriptor ต่อไฟล์ (LRU)"""
+    GOOD_MATCH_DISTANCE = 50
+
+    def __init__(self, cache_size=5000):
+        self.cache_size = cache_size
+        self._matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+        self._cache = OrderedDict()  # img_path -> descriptors
+        self._lock = threading.Lock()
+
+    def descriptors(self, img_path, loader):
+        """คืน descriptor ของไฟล์จาก cache หรือโหลดด้วย loader(img_path)"""
+        with self._lock:
+            if img_path in self._cache:
+                self._cache.move_to_end(img_path)
+                return self._cache[img_path]
+
+        descriptors = loader(img_path)
+        with self._lock:
+            self._cache[img_path] = descriptors
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return descriptors
+
+    def discard(self, img_path):
+        with self._lock:
+            self._cache.pop(img_path, None)
+
+    def count_good_matches(self, ref_descriptors, descriptors):
+        """คืน (จำนวน match ที่ distance < 50, จำนวน match ทั้งหมด) โดยไม่ต้อง sort"""
+        with self._lock:
+            matches = self._matcher.match(ref_descriptors, descriptors)
+        if not matches:
+            return 0, 0
+        distances = np.fromiter((m.distance for m in matches), dtype=np.float32, count=len(matches))
+        return int(np.count_nonzero(distances < self.GOOD_MATCH_DISTANCE)), len(matches)
+
+    def similarity(self, ref_descriptors, descriptors):
+        """สัดส่วน match ที่ดีของ descriptor สองชุด (0 ถ้าชุดใดว่าง)"""
+        if ref_descriptors is None or ref_descriptors.shape[0] == 0:
+            return 0.0
+        if descriptors is None or descriptors.shape[0] == 0:
+            return 0.0
+        good, total = self.count_good_matches(ref_descriptors, descriptors)
+        return good / total if total else 0.0
+
+    def batch_similarity(self, ref_descriptors, img_paths, loader):
+        """คะแนน ORB ของรูปต้นแบบเทียบกับหลายไฟล์ (descriptor จาก cache) คืน array"""
+        scores = np.zeros(len(img_paths), dtype=np.float64)
+        if ref_descriptors is None or ref_descriptors.shape[0] == 0:
+            return scores
+        for i, img_path in enumerate(img_paths):
+            scores[i] = self.similarity(ref_descriptors, self.descriptors(img_path, loader))
+        return scores
+
+def hash_distance_limit(threshold):
+    """ระยะ Hamming ถ่วงน้ำหนัก (2*aHash + 3*dHash) สูงสุดที่ยังอาจได้คะแนน >= threshold
+
+    ถ้า histogram และ ORB ได้เต็ม คะแนนสูงสุดคือ 1 - (0.2*ha + 0.3*hd) / 64
+    จึงต้องมี 2*ha + 3*hd <= 640 * (1 - threshold)
+    """
+    return int(np.floor(640 * (1.0 - threshold) + 1e-9))
+
+class HammingIndex:
+    """BK-tree ของ (aHash, dHash) ใช้หารูปที่อยู่ในรัศมี Hamming ของรูปต้นแบบ
+
+    ระยะที่ใช้คือ 2*ระยะ aHash + 3*ระยะ dHash (ตามน้ำหนัก 0.2/0.3 ของคะแนน)
+    ซึ่งยังเป็น metric จึงตัดกิ่งด้วย triangle inequality ได้
+    """
+
+    def __init__(self):
+        self._root = None  # [avg_hash, d_hash, paths, children]
+        self._removed = set()
+        self.size = 0
+
+    @staticmethod
+    def distance(a1, d1, a2, d2):
+        return 2 * hamming_distance(a1, a2) + 3 * hamming_distance(d1, d2)
+
+    def add(self, img_path, avg_hash, d_hash):
+        """เพิ่มรูปเข้า index"""
+        self._removed.discard(img_path)
+        self.size += 1
+        if self._root is None:
+            self._root = [avg_hash, d_hash, [img_path], {}]
+            return
+
+        node = self._root
+        while True:
+            dist = self.distance(avg_hash, d_hash, node[0], node[1])
+            if dist == 0:
+                node[2].append(img_path)
+                return
+            child = node[3].get(dist)
+            if child is None:
+                node[3][dist] = [avg_hash, d_hash, [img_path], {}]
+                return
+            node = child
+
+    def discard(self, img_path):
+        """ตัดรูปออกจากผลค้นหา (เช่น เมื่อถูกย้ายไปแล้ว)"""
+        self._removed.add(img_path)
+
+    def query(self, avg_hash, d_hash, radius):
+        """คืน set ของ path ที่มีระยะ <= radius"""
+        found = set()
+        if self._root is None:
+            return found
+
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            dist = self.distance(avg_hash, d_hash, node[0], node[1])
+            if dist <= radius:
+                found.update(node[2])
+            # ลูกที่ระยะอยู่นอกช่วง [dist - radius, dist + radius] ไม่มีทางอยู่ในรัศมี
+            for child_dist, child in node[3].items():
+                if dist - radius <= child_dist <= dist + radius:
+                    stack.append(child)
+
+        return found - self._removed
+
+def _hash_band_buckets(hashes, bands, max_bucket):
+    """จัดกลุ่มแถวที่มีบิตช่วงเดียวกันของ hash ตรงกัน (LSH แบบ banding)
+
+    bucket ที่ใหญ่เกิน max_bucket จะถูกแบ่งย่อยด้วยบิตของช่วงถัดไปเพิ่มทีละช่วง
+    จนเล็กพอหรือใช้ครบทั้ง hash แล้ว (แถวที่ hash ตรงกันทั้งหมดยังอยู่ bucket เดียวกันเสมอ)
+    คืน (buckets, row_buckets) โดย buckets คือ list ของ index array และ row_buckets[row, band]
+    คือ id ของ bucket ที่แถวนั้นอยู่ (-1 ถ้า bucket มีแถวเดียว)
+    """
+    bits = 64 // bands
+    buckets = []
+    row_buckets = np.full((len(hashes), bands), -1, dtype=np.int64)
+    for band in range(bands):
+        # หมุนบิตให้ช่วงนี้อยู่ต่ำสุด ช่วงถัดไปจึงต่อท้ายได้ด้วยการขยาย mask
+        shift = band * bits
+        rotated = hashes if shift == 0 else (hashes >> np.uint64(shift)) | (hashes << np.uint64(64 - shift))
+        pending = [(np.arange(len(hashes)), 1)]
+        while pending:
+            rows, width = pending.pop()
+            mask = np.uint64((1 << min(64, width * bits)) - 1)
+            values = rotated[rows] & mask
+            order = np.argsort(values, kind='stable')
+            boundaries = np.flatnonzero(np.diff(values[order])) + 1
+            for group in np.split(rows[order], boundaries):
+                if len(group) < 2:
+                    continue
+                if len(group) > max_bucket and width < bands:
+                    pending.append((group, width + 1))
+                    continue
+                row_buckets[group, band] = len(buckets)
+                buckets.append(group)
+    return buckets, row_buckets
+
+def cluster_near_duplicates(features, threshold, bands=4, max_bucket=5000):
+    """จัดกลุ่มรูปคล้ายทั้งชุดในครั้งเดียว (features จาก stack_features)
+
+    หาเพื่อนบ้านโดยประมาณจากรูปที่บางช่วงบิตของ aHash หรือ dHash ตรงกัน แล้วรับเป็น member
+    ถ้าคะแนนสูงสุดที่เป็นไปได้ (กรณี ORB ดีที่สุด แบบเดียวกับ score_similarity_cascade) ถึง threshold
+    member จึงเป็นแค่ "ผู้สมัคร" ต้องยืนยันด้วยคะแนนจริงที่รวม ORB ก่อนใช้ (score เป็นค่าขอบบน)
+    รูปแรกของแต่ละกลุ่มตามลำดับเป็นรูปต้นแบบ
+    คืน list ของ (leader, [(member, score), ...]) เรียงตามลำดับ leader (กลุ่มที่มีรูปเดียวมี member ว่าง)
+    """
+    count = len(features['hist'])
+    if count == 0:
+        return []
+
+    buckets = []
+    row_buckets = []
+    for name in ('avg_hash', 'd_hash'):
+        kind_buckets, kind_rows = _hash_band_buckets(features[name], bands, max_bucket)
+        kind_rows[kind_rows >= 0] += len(buckets)
+        buckets.extend(kind_buckets)
+        row_buckets.append(kind_rows)
+    row_buckets = np.hstack(row_buckets)
+
+    assigned = np.zeros(count, dtype=bool)
+    clusters = []
+    for leader in range(count):
+        if assigned[leader]:
+            continue
+        assigned[leader] = True
+
+        bucket_ids = row_buckets[leader]
+        bucket_ids = bucket_ids[bucket_ids >= 0]
+        members = []
+        if bucket_ids.size:
+            candidates = np.unique(np.concatenate([buckets[i] for i in bucket_ids]))
+            candidates = candidates[~assigned[candidates]]
+            if candidates.size:
+                ref = {
+                    'hist': features['hist'][leader],
+                    'avg_hash': int(features['avg_hash'][leader]),
+                    'd_hash': int(features['d_hash'][leader]),
+                }
+                subset = {name: values[candidates] for name, values in features.items()}
+                hist_similarity, avg_hash_similarity, d_hash_similarity = cheap_similarity(ref, subset)
+                scores = np.maximum(
+                    combine_similarity(hist_similarity, avg_hash_similarity, d_hash_similarity,
+                                       np.ones(candidates.size)),
+                    combine_similarity(hist_similarity, avg_hash_similarity, d_hash_similarity,
+                                       np.zeros(candidates.size)),
+                )
+                keep = scores >= threshold
+                assigned[candidates[keep]] = True
+                members = list(zip(candidates[keep].tolist(), scores[keep].tolist()))
+        clusters.append((leader, members))
+    return clusters
+
+class FeatureIndex:
+    """Index ของ feature ความคล้ายบนดิสก์ (SQLite) key = path + mtime + size
+
+    คำนวณ feature ของแต่ละรูปครั้งเดียว แล้วการค้นหารูปคล้ายครั้งต่อไปใช้แค่การเทียบ vector
+    ถ้าให้ metrics จะจับเวลาขั้น 'features' เฉพาะตอนที่ต้องคำนวณจริง (ไม่นับรูปที่อยู่ใน index แล้ว)
+    """
+    FILENAME = '.similarity_index.sqlite'
+    COMMIT_EVERY = 200
+
+    def __init__(self, db_path, metrics=None):
+        self.db_path = db_path
+        self.metrics = metrics
+        self._lock = threading.RLock()
+        self._memory = {}  # path -> (mtime_ns, size, features)
+        self._pending = 0
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS features ("
+            " path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER,"
+            " hist BLOB, avg_hash BLOB, d_hash BLOB, orb BLOB)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def file_key(img_path):
+        st = os.stat(img_path)
+        return st.st_mtime_ns, st.st_size
+
+    @staticmethod
+    def _encode_orb(descriptors):
+        # b'' = คำนวณแล้วแต่ไม่มี keypoint, NULL = ยังไม่ได้คำนวณ
+        return descriptors.tobytes() if descriptors is not None and len(descriptors) else b''
+
+    @classmethod
+    def _encode(cls, features):
+        return (
+            features['hist'].astype(np.float32).tobytes(),
+            features['avg_hash'].to_bytes(8, 'big'),
+            features['d_hash'].to_bytes(8, 'big'),
+            cls._encode_orb(features['orb']) if 'orb' in features else None,
+        )
+
+    @staticmethod
+    def _decode(hist, avg_hash, d_hash):
+        # ORB descriptor ไม่เก็บในหน่วยความจำของ index (ใช้ descriptors() + OrbMatcher cache แทน)
+        return {
+            'hist': np.frombuffer(hist, dtype=np.float32).copy(),
+            'avg_hash': int.from_bytes(avg_hash, 'big'),
+            'd_hash': int.from_bytes(d_hash, 'big'),
+        }
+
+    def lookup(self, img_path, key=None):
+        """คืน feature ที่เก็บไว้ถ้ายังตรงกับไฟล์ปัจจุบัน (ไม่ decode รูป)"""
+        try:
+            mtime_ns, size = key or self.file_key(img_path)
+        except OSError:
+            return None
+
+        with self._lock:
+            cached = self._memory.get(img_path)
+            if cached and cached[0] == mtime_ns and cached[1] == size:
+                return cached[2]
+
+            row = self._conn.execute(
+                "SELECT mtime_ns, size, hist, avg_hash, d_hash FROM features WHERE path = ?",
+                (img_path,)
+            ).fetchone()
+            if row is None or row[0] != mtime_ns or row[1] != size:
+                return None
+
+            features = self._decode(*row[2:])
+            self._memory[img_path] = (mtime_ns, size, features)
+            return features
+
+    def put(self, img_path, key, features):
+        """บันทึก feature ของไฟล์ลง index คืน feature ที่ไม่รวม ORB descriptor"""
+        mtime_ns, size = key
+        stored = {name: value for name, value in features.items() if name != 'orb'}
+        with self._lock:
+            self._memory[img_path] = (mtime_ns, size, stored)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (img_path, mtime_ns, size) + self._encode(features)
+            )
+            self._pending += 1
+            if self._pending >= self.COMMIT_EVERY:
+                self.flush()
+        return stored
+
+    def descriptors(self, img_path):
+        """อ่าน ORB descriptor ของไฟล์จาก index (คำนวณและบันทึกถ้ายังไม่เคยคำนวณ)"""
+        with self._lock:
+            row = self._conn.execute("SELECT orb FROM features WHERE path = ?", (img_path,)).fetchone()
+        if row is None:
+            return None
+
+        if row[0] is None:
+            started = time.perf_counter()
+            descriptors = extract_orb_descriptors(img_path)
+            self._record_features(time.perf_counter() - started)
+            with self._lock:
+                self._conn.execute("UPDATE features SET orb = ? WHERE path = ?",
+                                   (self._encode_orb(descriptors), img_path))
+                self._pending += 1
+            return descriptors
+
+        if not row[0]:
+            return None
+        return np.frombuffer(row[0], dtype=np.uint8).reshape(-1, 32).copy()
+
+    def get(self, img_path, with_orb=True):
+        """คืน feature ของไฟล์ คำนวณและบันทึกใหม่ถ้ายังไม่มีหรือไฟล์เปลี่ยน"""
+        try:
+            key = self.file_key(img_path)
+        except OSError:
+            return None
+
+        features = self.lookup(img_path, key)
+        if features is None:
+            started = time.perf_counter()
+            features = extract_image_features(img_path, with_orb)
+            self._record_features(time.perf_counter() - started)
+            if features is not None:
+                features = self.put(img_path, key, features)
+        return features
+
+    def get_many(self, img_paths, extractor=None, with_orb=True, block_size=256):
+        """Yield (img_path, features) ตามลำดับ รูปที่ยังไม่มีใน index ส่งให้ extractor คำนวณแบบขนาน"""
+        for start in range(0, len(img_paths), block_size):
+            block = img_paths[start:start + block_size]
+
+            found = {}
+            missing = []
+            for img_path in block:
+                try:
+                    key = self.file_key(img_path)
+                except OSError:
+                    continue
+                features = self.lookup(img_path, key)
+                if features is None:
+                    missing.append((img_path, key))
+                else:
+                    found[img_path] = features
+
+            if missing:
+                started = time.perf_counter()
+                paths = [img_path for img_path, _ in missing]
+                if extractor is not None:
+                    results = extractor.extract(paths, with_orb)
+                else:
+                    results = ((img_path, extract_image_features(img_path, with_orb)) for img_path in paths)
+                for (img_path, key), (_, features) in zip(missing, results):
+                    if features is not None:
+                        found[img_path] = self.put(img_path, key, features)
+                self._record_features(time.perf_counter() - started, len(missing))
+
+            for img_path in block:
+                if img_path in found:
+                    yield img_path, found[img_path]
+
+    def _record_features(self, seconds, count=1):
+        if self.metrics is not None:
+            self.metrics.record('features', seconds, count)
+
+    def prune(self, valid_paths):
+        """ลบรายการของไฟล์ที่ไม่อยู่ในโฟลเดอร์แล้ว (เช่น ถูกย้ายไปโฟลเดอร์ผลลัพธ์)"""
+        valid_paths = set(valid_paths)
+        with self._lock:
+            stale = [path for (path,) in self._conn.execute("SELECT path FROM features")
+                     if path not in valid_paths]
+            self._conn.executemany("DELETE FROM features WHERE path = ?", [(path,) for path in stale])
+            for path in stale:
+                self._memory.pop(path, None)
+            self._conn.commit()
+            self._pending = 0
+        return len(stale)
+
+    def flush(self):
+        with self._lock:
+            self._conn.commit()
+            self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+class SessionJournal:
+    """บันทึกการตัดสินใจ/การย้ายไฟล์ของ session ต่อท้ายไฟล์ (JSON ทีละบรรทัด) ในโฟลเดอร์รูปภาพ
+
+    ถ้าโปรแกรมปิดหรือหยุดกลางคัน การเริ่มโหมดเดิมกับโฟลเดอร์เดิมครั้งถัดไปจะทำต่อจากที่ค้างไว้
+    บรรทัดแรกคือหัว session {"session", "mode"} บรรทัดต่อไปคือ
+    {"src", "dst", "cls", "conf", "inc"} โดย dst = null ถ้าข้าม และ inc = key ของ stats ที่เพิ่มขึ้น
+    record() flush เองทุก FLUSH_EVERY บรรทัด (โหมดอัตโนมัติ flush ทีละ batch)
+    การตัดสินใจของผู้ใช้ควร flush(sync=True) ทันที ไม่ให้โปรแกรมที่ crash ลืมไฟล์ที่ย้ายไปแล้ว
+    """
+    FILENAME = '.sort_session.jsonl'
+    FLUSH_EVERY = 64
+
+    def __init__(self, folder_path):
+        self.folder_path = folder_path
+        self.path = os.path.join(folder_path, self.FILENAME)
+        self._lock = threading.Lock()
+        self._file = None
+        self._pending = 0
+
+    def relpath(self, path):
+        return os.path.relpath(path, self.folder_path)
+
+    def load(self):
+        """อ่าน session ที่ยังไม่จบ คืน dict(mode, stats, done) หรือ None ถ้าไม่มี"""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                lines = f.read().splitlines()
+        except OSError:
+            return None
+
+        session = None
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # บรรทัดสุดท้ายอาจเขียนไม่ครบตอนโปรแกรมปิด
+                continue
+            if 'session' in record:
+                session = {'mode': record['mode'], 'stats': new_stats(), 'done': set()}
+            elif session is not None:
+                session['done'].add(record['src'])
+                for key in record.get('inc', ()):
+                    session['stats'][key] = session['stats'].get(key, 0) + 1
+        if session is not None:
+            session['stats']['total'] = len(session['done'])
+        return session
+
+    def begin(self, mode):
+        """เริ่ม session ใหม่ (ล้าง journal เดิม)"""
+        with self._lock:
+            self._close_file()
+            self._file = open(self.path, 'w', encoding='utf-8')
+            self._write({'session': 1, 'mode': mode})
+            self._file.flush()
+
+    def resume(self):
+        """เปิด journal เดิมเพื่อบันทึกต่อท้าย"""
+        with self._lock:
+            self._close_file()
+            with open(self.path, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                last_byte = b'\n'
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    last_byte = f.read(1)
+            self._file = open(self.path, 'a', encoding='utf-8')
+            if last_byte != b'\n':
+                # ต่อจากบรรทัดที่เขียนไม่ครบ ให้ขึ้นบรรทัดใหม่ก่อน
+                self._file.write("\n")
+
+    def record(self, src, dst, class_name, confidence, *counters):
+        """บันทึกการตัดสินใจของไฟล์หนึ่งไฟล์ (dst = None ถ้าข้าม)"""
+        with self._lock:
+            if self._file is None:
+                return
+            self._write({
+                'src': self.relpath(src),
+                'dst': self.relpath(dst) if dst else None,
+                'cls': class_name,
+                'conf': round(confidence, 6) if confidence is not None else None,
+                'inc': counters,
+            })
+            self._pending += 1
+            if self._pending >= self.FLUSH_EVERY:
+                self._file.flush()
+                self._pending = 0
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n")
+
+    def flush(self, sync=False):
+        """เขียนบรรทัดที่ค้างใน buffer ลงไฟล์ (sync=True: fsync ให้ถึงดิสก์ด้วย)"""
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                if sync:
+                    os.fsync(self._file.fileno())
+                self._pending = 0
+
+    def complete(self):
+        """จบ session แล้ว ลบ journal ทิ้ง (ครั้งถัดไปเริ่มใหม่)"""
+        with self._lock:
+            self._close_file()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def close(self):
+        with self._lock:
+            self._close_file()
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class UIDispatcher:
+    """คิวงาน UI แบบ thread-safe: thread ไหนก็ส่งงานเข้าคิวได้ Tk thread รันทีละชุดทุก INTERVAL_MS
+
+    งานที่ส่งผ่าน call_coalesced ด้วย key เดียวกันซ้ำก่อนถึงรอบจะรันครั้งเดียว (เช่น update_stats)
+    แต่ละรอบรันไม่เกิน MAX_PER_TICK งาน ที่เหลือรอรอบถัดไปเพื่อไม่ให้ UI ค้าง
+    """
+    INTERVAL_MS = 50
+    MAX_PER_TICK = 200
+
+    def __init__(self, root):
+        self.root = root
+        self._queue = deque()  # (func, args) — append/popleft ของ deque thread-safe อยู่แล้ว
+        self._coalesced = {}  # key -> func
+        self._lock = threading.Lock()
+        self.root.after(self.INTERVAL_MS, self._drain)
+
+    def call(self, func, *args):
+        """ให้ Tk thread เรียก func(*args) ตามลำดับที่ส่งเข้ามา"""
+        self._queue.append((func, args))
+
+    def call_coalesced(self, key, func):
+        """ให้ Tk thread เรียก func ครั้งเดียวในรอบถัดไป ไม่ว่าจะส่งมากี่ครั้ง"""
+        with self._lock:
+            self._coalesced[key] = func
+
+    def _drain(self):
+        for _ in range(min(len(self._queue), self.MAX_PER_TICK)):
+            func, args = self._queue.popleft()
+            self._run(func, args)
+        with self._lock:
+            coalesced = list(self._coalesced.values())
+            self._coalesced.clear()
+        for func in coalesced:
+            self._run(func, ())
+        try:
+            # ยังมีงานค้าง → กลับมาเร็วๆ หลังให้ event loop วาดหน้าจอก่อน
+            self.root.after(1 if self._queue else self.INTERVAL_MS, self._drain)
+        except tk.TclError:
+            # หน้าต่างหลักถูกปิดแล้ว
+            pass
+
+    @staticmethod
+    def _run(func, args):
+        try:
+            func(*args)
+        except Exception:
+            logger.exception("UI task %s failed", getattr(func, '__name__', func))
+
+class LogSinkHandler(logging.Handler):
+    """ส่ง record ของ logger ของโมดูลเข้า LogSink (กล่อง log + ไฟล์ log)"""
+
+    def __init__(self, sink):
+        super().__init__(logging.INFO)
+        self.sink = sink
+
+    def emit(self, record):
+        try:
+            if record.levelno >= logging.ERROR:
+                level = "error"
+            elif record.levelno >= logging.WARNING:
+                level = "warning"
+            else:
+                level = "info"
+            self.sink.write(self.format(record), level)
+        except Exception:
+            self.handleError(record)
+
+class LogSink:
+    """รับ log จากทุก thread แล้วเขียนลง Tk Text เป็นชุดทุก FLUSH_INTERVAL_MS
+
+    widget เก็บไว้ไม่เกิน max_lines บรรทัด (ลบบรรทัดเก่าออก) และข้อความที่รอแสดงไม่เกิน max_pending
+    ถ้ากำหนด file_path จะเขียน log แบบ JSON lines ลงไฟล์ที่ rotate ตามขนาดด้วย
+    (ผ่าน QueueHandler: การเขียนไฟล์และ rotate ทำใน thread ของ QueueListener ไม่ใช่ thread ที่เรียก log)
+    record ของ logger ของโมดูล (logger.exception ฯลฯ) ก็เข้ามาที่นี่ด้วยผ่าน LogSinkHandler
+    """
+    FLUSH_INTERVAL_MS = 100
+    LEVELS = ("info", "success", "warning", "error")
+    MAX_MESSAGE_LENGTH = 1000
+
+    def __init__(self, root, widget, max_lines=5000, max_pending=10000,
+                 file_path=None, max_bytes=5 * 1024 * 1024, backup_count=3):
+        self.root = root
+        self.widget = widget
+        self.max_lines = max_lines
+        self.max_pending = max_pending
+        self._pending = deque()  # (time, level, message)
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._file_logger = None
+        self._file_listener = None
+        self._handler = LogSinkHandler(self)
+        logger.addHandler(self._handler)
+        logger.setLevel(logging.INFO)
+        if file_path:
+            self._open_file_log(file_path, max_bytes, backup_count)
+        self.root.after(self.FLUSH_INTERVAL_MS, self._flush)
+
+    def _open_file_log(self, file_path, max_bytes, backup_count):
+        try:
+            os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+            handler = RotatingFileHandler(file_path, maxBytes=max_bytes,
+                                          backupCount=backup_count, encoding='utf-8')
+        except OSError as e:
+            logger.warning("ไม่สามารถเปิดไฟล์ log ได้ (บันทึกเฉพาะในกล่อง log): %s", e)
+            return
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        records = queue.SimpleQueue()
+        self._file_listener = QueueListener(records, handler)
+        self._file_listener.start()
+        file_logger = logging.getLogger(f"{__name__}.session")
+        file_logger.propagate = False
+        file_logger.setLevel(logging.INFO)
+        file_logger.handlers[:] = [QueueHandler(records)]
+        self._file_logger = file_logger
+
+    def write(self, message, level="normal"):
+        """เพิ่มข้อความ (เรียกจาก thread ไหนก็ได้)"""
+        message = str(message)
+        if len(message) > self.MAX_MESSAGE_LENGTH:
+            message = message[:self.MAX_MESSAGE_LENGTH] + "..."
+        now = time.time()
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self._pending.popleft()
+                self._dropped += 1
+            self._pending.append((now, level, message))
+        if self._file_logger is not None:
+            self._file_logger.info(json.dumps(
+                {'time': round(now, 3), 'level': level, 'message': message}, ensure_ascii=False))
+
+    def _flush(self):
+        with self._lock:
+            batch = list(self._pending)
+            self._pending.clear()
+            dropped, self._dropped = self._dropped, 0
+        if batch or dropped:
+            try:
+                self._insert(batch, dropped)
+            except tk.TclError:
+                # widget ถูกปิดไปแล้ว
+                return
+        self.root.after(self.FLUSH_INTERVAL_MS, self._flush)
+
+    def _insert(self, batch, dropped):
+        # insert ทั้งชุดด้วยคำสั่งเดียว: text, tags, text, tags, ...
+        chunks = []
+        if dropped:
+            chunks += [f"[...] ข้าม {dropped} ข้อความ (log เข้ามาเร็วเกินไป)\n", "warning"]
+        for timestamp, level, message in batch:
+            chunks += [time.strftime("[%H:%M:%S] ", time.localtime(timestamp)), "info",
+                       message + "\n", level if level in self.LEVELS else ()]
+
+        self.widget.config(state=tk.NORMAL)
+        self.widget.insert(tk.END, *chunks)
+        lines = int(self.widget.index('end-1c').split('.')[0]) - 1
+        if lines > self.max_lines:
+            self.widget.delete('1.0', f"{lines - self.max_lines + 1}.0")
+        self.widget.see(tk.END)
+        self.widget.config(state=tk.DISABLED)
+
+    def close(self):
+        logger.removeHandler(self._handler)
+        if self._file_listener is not None:
+            self._file_listener.stop()  # เขียน record ที่ค้างในคิวให้หมดก่อน
+            for handler in self._file_listener.handlers:
+                handler.close()
+            self._file_listener = None
+
+class ThumbnailGrid:
+    """ตารางรูปที่คล้ายกันแบบ virtualized ในหน้าต่างตัดสินใจ
+
+    สร้าง widget เฉพาะแถวที่มองเห็น (ลบทิ้งเมื่อเลื่อนพ้น) และ decode thumbnail ใน worker thread
+    แล้วค่อยเติมรูปเมื่อโหลดเสร็จ event ของแต่ละรูปส่งต่อให้ handler เดิมของ sorter
+    """
+    THUMBNAIL_SIZE = (250, 200)
+    CELL_WIDTH = 280
+    CELL_HEIGHT = 320
+    OVERSCAN_ROWS = 1  # จำนวนแถวนอกจอที่สร้างเผื่อไว้
+
+    def __init__(self, sorter, parent, items, executor):
+        self.sorter = sorter
+        self.items = items
+        self.executor = executor
+        self.columns = 0
+        self.cells = {}  # index -> (canvas window id, img_frame)
+        self.photos = {}  # index -> PhotoImage ของ cell ที่ยังอยู่
+        self.pending = {}  # index -> Future ของ thumbnail ที่กำลังโหลด
+        self.closed = False
+        self._refresh_scheduled = False
+
+        self.canvas = tk.Canvas(parent, bg=sorter.style.SECONDARY_BG, highlightthickness=0,
+                                yscrollincrement=20)
+        self.scrollbar = ttk.Scrollbar(parent, orient="vertical", command=self.canvas.yview)
+        self.canvas.configure(yscrollcommand=self._on_scroll)
+        self.canvas.pack(side="left", fill="both", expand=True)
+        self.scrollbar.pack(side="right", fill="y")
+
+        # สถานะ drag ที่ on_image_click / on_drag_* ใช้ (img_frame.master คือ canvas)
+        self.canvas.is_dragging = False
+        self.canvas.drag_start_widget = None
+
+        self.canvas.bind("<Configure>", lambda e: self.schedule_refresh())
+        self.canvas.bind("<MouseWheel>", self.on_mouse_wheel)
+        self.canvas.bind("<Destroy>", lambda e: self.close() if e.widget is self.canvas else None)
+
+    def on_mouse_wheel(self, event):
+        self.canvas.yview_scroll(int(-1*(event.delta/120)), "units")
+
+    def _on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        self.schedule_refresh()
+
+    def schedule_refresh(self):
+        if not self._refresh_scheduled and not self.closed:
+            self._refresh_scheduled = True
+            self.canvas.after_idle(self.refresh)
+
+    def refresh(self):
+        """สร้าง/ลบ cell ให้ตรงกับแถวที่มองเห็นตอนนี้"""
+        self._refresh_scheduled = False
+        if self.closed:
+            return
+
+        columns = max(1, self.canvas.winfo_width() // self.CELL_WIDTH)
+        if columns != self.columns:
+            # ความกว้างเปลี่ยน ตำแหน่งทุก cell เปลี่ยน สร้างใหม่หมด
+            for index in list(self.cells):
+                self._destroy_cell(index)
+            self.columns = columns
+            rows = (len(self.items) + columns - 1) // columns
+            self.canvas.configure(scrollregion=(0, 0, columns * self.CELL_WIDTH, rows * self.CELL_HEIGHT))
+
+        top = self.canvas.canvasy(0)
+        bottom = top + self.canvas.winfo_height()
+        first_row = max(0, int(top // self.CELL_HEIGHT) - self.OVERSCAN_ROWS)
+        last_row = int(bottom // self.CELL_HEIGHT) + self.OVERSCAN_ROWS
+        visible = range(first_row * columns, min(len(self.items), (last_row + 1) * columns))
+
+        for index in list(self.cells):
+            if index not in visible:
+                self._destroy_cell(index)
+        for index in visible:
+            if index not in self.cells:
+                self._create_cell(index)
+
+    def _create_cell(self, index):
+        sorter = self.sorter
+        img_path, similarity = self.items[index]
+        row, col = divmod(index, self.columns)
+
+        img_frame = ttk.Frame(self.canvas, style='Card.TFrame', padding=5)
+        window_id = self.canvas.create_window(col * self.CELL_WIDTH + 5, row * self.CELL_HEIGHT + 5,
+                                              window=img_frame, anchor="nw",
+                                              width=self.CELL_WIDTH - 10, height=self.CELL_HEIGHT - 10)
+        self.cells[index] = (window_id, img_frame)
+
+        # รูป (แสดงข้อความจนกว่า thumbnail จะโหลดเสร็จ)
+        img_label = ttk.Label(img_frame, text="กำลังโหลด...", background=sorter.style.SECONDARY_BG,
+                              anchor=tk.CENTER)
+        img_label.pack(pady=(0, 5), expand=True)
+
+        filename = os.path.basename(img_path)
+        info_label = ttk.Label(img_frame, text=f"{filename}\nความคล้าย: {similarity:.2%}",
+                               background=sorter.style.SECONDARY_BG, justify=tk.CENTER, wraplength=200)
+        info_label.pack(pady=(0, 5))
+
+        unselected = img_path in sorter.unselected_images
+        unselect_btn = ttk.Button(
+            img_frame,
+            text="Selected" if unselected else "Unselect",
+            command=lambda: sorter.toggle_image_selection(img_path, img_frame),
+            style='TButton' if unselected else 'Unselect.TButton'
+        )
+        unselect_btn.pack(pady=(0, 5))
+
+        # เก็บข้อมูลไว้ใน frame (ใช้ใน toggle_image_selection / find_img_frame_from_widget)
+        img_frame.unselect_btn = unselect_btn
+        img_frame.img_path = img_path
+        img_frame.img_label = img_label
+        img_frame.info_label = info_label
+
+        # click ที่รูปหรือข้อมูล, drag เฉพาะที่รูป, hover
+        click_handler = lambda event: sorter.on_image_click(event, img_path, img_frame)
+        img_label.bind("<Button-1>", click_handler)
+        info_label.bind("<Button-1>", click_handler)
+        img_label.bind("<ButtonPress-1>", lambda event: sorter.on_drag_start(event, img_path, img_frame, self.canvas), add="+")
+        img_label.bind("<B1-Motion>", lambda event: sorter.on_drag_motion(event, self.canvas))
+        img_label.bind("<ButtonRelease-1>", lambda event: sorter.on_drag_end(event, self.canvas))
+        img_label.bind("<Enter>", lambda event: sorter.on_image_hover_enter(event, img_frame))
+        img_label.bind("<Leave>", lambda event: sorter.on_image_hover_leave(event, img_frame))
+        for widget in (img_frame, img_label, info_label):
+            widget.bind("<MouseWheel>", self.on_mouse_wheel)
+
+        sorter.update_image_visual_state(img_frame)
+
+        future = self.executor.submit(sorter.load_thumbnail, img_path, self.THUMBNAIL_SIZE)
+        self.pending[index] = future
+        future.add_done_callback(lambda f: self._thumbnail_ready(index, f))
+
+    def _thumbnail_ready(self, index, future):
+        # เรียกจาก worker thread → ส่งต่อไป Tk thread
+        if not self.closed and not future.cancelled():
+            self.sorter.ui.call(self._show_thumbnail, index, future)
+
+    def _show_thumbnail(self, index, future):
+        if self.closed or self.pending.get(index) is not future:
+            return
+        del self.pending[index]
+        img_frame = self.cells[index][1]
+        try:
+            photo = ImageTk.PhotoImage(future.result())
+        except Exception as e:
+            self.sorter.log(f"แสดงรูปไม่ได้ {self.items[index][0]}: {e}", "error")
+            img_frame.img_label.configure(text="อ่านรูปไม่ได้")
+            return
+        self.photos[index] = photo
+        img_frame.img_label.configure(image=photo, text="")
+
+    def _destroy_cell(self, index):
+        window_id, img_frame = self.cells.pop(index)
+        future = self.pending.pop(index, None)
+        if future is not None:
+            future.cancel()
+        self.photos.pop(index, None)
+        self.canvas.delete(window_id)
+        img_frame.destroy()
+
+    def close(self):
+        """ยกเลิก thumbnail ที่ยังไม่โหลดและคืนหน่วยความจำ (เมื่อปิดหน้าต่าง)"""
+        self.closed = True
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.photos.clear()
+        self.cells.clear()
+
 class YOLOImageSimilaritySorter:
     def __init__(self, root):
         self.root = root
@@ -52,6 +2065,9 @@ class YOLOImageSimilaritySorter:
         self.root.minsize(800, 600)
         self.root.resizable(True, True)
         
+        # งาน UI จาก worker thread ทั้งหมดส่งผ่าน dispatcher นี้
+        self.ui = UIDispatcher(self.root)
+        
         # Set Dark Mode theme
         self.style = DarkModeStyle()
         self.setup_theme()
@@ -60,14 +2076,31 @@ class YOLOImageSimilaritySorter:
         self.folder_path = ""
         self.target_folders = {}
         
-        # Image file list
-        self.image_files = []
+        # Image file list (WorkingSet: ไฟล์ที่ย้ายแล้วถูกตัดออกโดยไม่ต้องสร้าง list ใหม่)
+        self.image_files = WorkingSet()
         self.current_index = 0
         
         # YOLOv8 model
         self.model = None
+        self.model_path = 'best-cls-v2.pt'
+        self.prediction_cache = None  # cache ผลทำนาย (ข้ามรูปที่เคยทำนายด้วยโมเดลเดียวกัน)
+        self.journal = None  # SessionJournal ของโฟลเดอร์ (ทำต่อจากที่ค้างไว้ได้)
+        self._current_prediction = (None, None)  # (class_name, confidence) ของรูปต้นแบบปัจจุบัน
         self.is_running = False
-        
+        self.batch_size = 32  # จำนวนรูปต่อ batch ในโหมดอัตโนมัติ
+        self.prefetch_depth = 128  # จำนวนรูปที่ decode ล่วงหน้าได้สูงสุด
+        self.watch_mode = False  # โหมดอัตโนมัติ: เฝ้าดูไฟล์ใหม่ต่อหลังทำไฟล์เดิมครบ
+        self.recursive = False  # รวมไฟล์ในโฟลเดอร์ย่อย (ผลลัพธ์คงโครงสร้างโฟลเดอร์ย่อยเดิม)
+        self.watch_interval = 2.0  # วินาทีระหว่างการตรวจไฟล์ใหม่ใน watch mode
+
+        # งานล่วงหน้าระหว่างที่ผู้ใช้ตัดสินใจ (โหมดปกติ)
+        self.lookahead_size = 64  # จำนวนรูปถัดไปที่จำแนกล่วงหน้า
+        self._predictions = {}  # img_path -> (class_name, confidence)
+        self._speculative_search = None
+        self._speculation_generation = 0
+        self._speculation_lock = threading.Lock()  # ตรวจ generation กับเขียนผลล่วงหน้าในจังหวะเดียวกัน
+        self._move_log = []
+
         # เพิ่มตัวแปรโหมด
         self.mode = "normal"  # "normal" หรือ "not_car_auto"
         
@@ -75,44 +2108,38 @@ class YOLOImageSimilaritySorter:
         self.similar_images = []
         self.unselected_images = set()  # เก็บรูปที่กด "unselect"
         self.threshold = 0.8  # ค่าความคล้าย (0-1)
+        self.feature_index = None  # index ของ feature ความคล้าย (เก็บในโฟลเดอร์รูปภาพ)
+        self.hash_index = None  # HammingIndex ของ aHash/dHash (สร้างใน background)
+        self.feature_workers = default_feature_workers()  # จำนวน process ที่ใช้คำนวณ feature
+        self.feature_extractor = ParallelFeatureExtractor(self.feature_workers)
+        self.orb_matcher = OrbMatcher()
+        self.cascade_scoring = True  # ข้าม ORB ของรูปที่ไม่มีทางผ่าน threshold
+        self.cluster_prepass = False  # จัดกลุ่มรูปคล้ายทั้งโฟลเดอร์ก่อน แล้วให้ตัดสินทีละกลุ่ม
+        self.clusters = None  # {'threshold', 'members': {leader_path: [(path, score), ...]}}
         
         # Target classes in ImageNet related to vehicles and people
-        self.target_class_keywords = [
-            # People
-            'person', 'man', 'woman', 'child', 'boy', 'girl', 'human',
-            # Bicycles
-            'bicycle', 'bike', 'cycle', 'mountain bike',
-            # Cars
-            'car', 'automobile', 'cab', 'taxi', 'jeep', 'sport car', 'passenger car',
-            # Motorcycles
-            'motorcycle', 'motorbike', 'motor scooter', 'scooter',
-            # Airplanes
-            'airplane', 'aircraft', 'plane', 'airliner', 'warplane', 'jet',
-            # Buses
-            'bus', 'coach', 'minibus', 'trolleybus',
-            # Trains
-            'train', 'locomotive', 'railway', 'railroad car', 'passenger car',
-            # Trucks
-            'truck', 'pickup', 'tractor', 'trailer truck', 'delivery truck',
-            # Boats
-            'boat', 'ship', 'sailboat', 'speedboat', 'canoe', 'vessel'
-        ]
+        self.target_class_keywords = list(TARGET_CLASS_KEYWORDS)
         
         # Statistics
-        self.stats = {
-            'total': 0,
-            'processed': 0,
-            'car': 0,
-            'not_car': 0,
-            'auto_not_car': 0,
-            'similar_moved': 0,
-            'skipped': 0  # เพิ่มสถิติรูปที่ skip
-        }
+        self.stats = new_stats()
+        self.metrics = PipelineMetrics()  # เวลาต่อขั้นของ pipeline (แสดงในแผงสถิติ, export ตอนจบ)
+        self.move_executor = MoveExecutor(self.metrics)  # ย้ายไฟล์ของการตัดสินใจใน background
+        self.classifier = None  # BatchClassifier ของรอบปัจจุบัน (โหมดปกติ จำแนกทีละรูป)
+        self.classify_executor = ThreadPoolExecutor(max_workers=1)  # จำแนกรูปปัจจุบันนอก Tk thread
+        self.thumbnail_executor = ThreadPoolExecutor(max_workers=4)  # decode thumbnail ของหน้าต่างตัดสินใจ
+        try:
+            self.thumbnail_cache = ThumbnailCache.open_default(log=self.log)  # thumbnail ที่เคย decode แล้ว
+        except OSError as e:
+            print(f"Thumbnail cache disabled: {e}")
+            self.thumbnail_cache = None
         
         # Setup UI
         self.setup_ui()
         self.setup_additional_styles()
         self.debug_check_methods()
+
+        # โหลดโมเดลล่วงหน้าใน background เพื่อให้กดเริ่มแล้วจำแนกได้ทันที
+        threading.Thread(target=self._preload_model, daemon=True).start()
         
     def setup_theme(self):
         """กำหนดธีม Dark Mode สำหรับ ttk"""
@@ -310,6 +2337,7 @@ class YOLOImageSimilaritySorter:
         self.auto_not_car_var = tk.StringVar(value="Not Car (อัตโนมัติ): 0")
         self.skipped_var = tk.StringVar(value="ข้าม: 0")
         self.similar_moved_var = tk.StringVar(value="รูปที่คล้ายที่ย้ายแล้ว: 0")
+        self.move_failed_var = tk.StringVar(value="ย้ายไม่สำเร็จ: 0")
 
         # Display statistics in a grid layout
         ttk.Label(stats_row1, textvariable=self.total_var, style='Stats.TLabel').pack(side=tk.LEFT, expand=True, fill=tk.X, padx=1)
@@ -330,6 +2358,12 @@ class YOLOImageSimilaritySorter:
 
         ttk.Label(stats_row3, textvariable=self.skipped_var, style='Stats.TLabel').pack(side=tk.LEFT, expand=True, fill=tk.X, padx=1)
         ttk.Label(stats_row3, textvariable=self.similar_moved_var, style='Stats.TLabel').pack(side=tk.LEFT, expand=True, fill=tk.X, padx=1)
+        ttk.Label(stats_row3, textvariable=self.move_failed_var, style='Stats.TLabel').pack(side=tk.LEFT, expand=True, fill=tk.X, padx=1)
+
+        # Timing row (PipelineMetrics)
+        self.timing_var = tk.StringVar(value="เวลาต่อรูป: -")
+        ttk.Label(stats_frame, textvariable=self.timing_var, style='Stats.TLabel',
+                  wraplength=900).pack(fill=tk.X, pady=(1, 0))
         
         # =========== Progress bar ===========
         progress_frame = ttk.Frame(main_frame, style='TFrame')
@@ -361,6 +2395,21 @@ class YOLOImageSimilaritySorter:
         self.stop_button = ttk.Button(control_frame, text="หยุด", 
                                     command=self.stop_sorting, state=tk.DISABLED)
         self.stop_button.pack(side=tk.LEFT)
+
+        # เฝ้าดูไฟล์ใหม่ที่วางเพิ่มในโฟลเดอร์ (โหมดอัตโนมัติ)
+        self.watch_var = tk.BooleanVar(value=False)
+        watch_check = ttk.Checkbutton(control_frame, text="เฝ้าดูไฟล์ใหม่ (Auto)", variable=self.watch_var)
+        watch_check.pack(side=tk.LEFT, padx=(10, 0))
+
+        # รวมไฟล์ในโฟลเดอร์ย่อย (เช่น โฟลเดอร์วันที่/ชั่วโมงของกล้อง)
+        self.recursive_var = tk.BooleanVar(value=False)
+        recursive_check = ttk.Checkbutton(control_frame, text="รวมโฟลเดอร์ย่อย", variable=self.recursive_var)
+        recursive_check.pack(side=tk.LEFT, padx=(10, 0))
+
+        # จัดกลุ่มรูปคล้ายทั้งโฟลเดอร์ก่อนตัดสิน (โหมดปกติ)
+        self.cluster_var = tk.BooleanVar(value=False)
+        cluster_check = ttk.Checkbutton(control_frame, text="จัดกลุ่มรูปคล้ายก่อน", variable=self.cluster_var)
+        cluster_check.pack(side=tk.LEFT, padx=(10, 0))
         
         # แสดงโหมดปัจจุบัน
         self.mode_var = tk.StringVar(value="โหมด: ปกติ")
@@ -392,6 +2441,10 @@ class YOLOImageSimilaritySorter:
         self.log_text.tag_configure("warning", foreground=self.style.WARNING_COLOR)
         self.log_text.tag_configure("error", foreground=self.style.ERROR_COLOR)
         
+        # log จากทุก thread ผ่าน LogSink (แสดงเป็นชุด + เก็บลงไฟล์ใน CACHE_DIR/logs)
+        self.log_sink = LogSink(self.root, self.log_text,
+                                file_path=os.path.join(CACHE_DIR, "logs", "sorter.jsonl"))
+        
         # Welcome message
         self.log("YOLOv8 Image Similarity Sorter started", "info")
         self.log("กรุณาเลือกโฟลเดอร์รูปภาพเพื่อเริ่มต้น")
@@ -449,24 +2502,13 @@ class YOLOImageSimilaritySorter:
             self.log(f"เลือกโฟลเดอร์: {folder_path}", "info")
             
     def log(self, message, level="normal"):
-        """Add a message to the log area"""
-        self.log_text.config(state=tk.NORMAL)
-        
-        # Add timestamp before message
-        from datetime import datetime
-        timestamp = datetime.now().strftime("[%H:%M:%S] ")
-        self.log_text.insert(tk.END, timestamp, "info")
-        
-        # Add message with appropriate color based on level
-        if level in ["info", "success", "warning", "error"]:
-            self.log_text.insert(tk.END, message + "\n", level)
-        else:
-            self.log_text.insert(tk.END, message + "\n")
-            
-        self.log_text.see(tk.END)
-        self.log_text.config(state=tk.DISABLED)
-        self.root.update()
+        """Add a message to the log area (เรียกจาก thread ไหนก็ได้ แสดงผลเป็นชุดผ่าน LogSink)"""
+        self.log_sink.write(message, level)
         
+    def request_stats_update(self):
+        """ขอให้ update_stats ในรอบถัดไปของ UIDispatcher (เรียกซ้ำถี่ๆ จาก thread ไหนก็ได้)"""
+        self.ui.call_coalesced('update_stats', self.update_stats)
+
     def update_stats(self):
         """Update the statistics text"""
         # Calculate progress percentage
@@ -483,6 +2525,8 @@ class YOLOImageSimilaritySorter:
         self.auto_not_car_var.set(f"Not Car (อัตโนมัติ): {self.stats['auto_not_car']}")
         self.skipped_var.set(f"ข้าม: {self.stats['skipped']}")
         self.similar_moved_var.set(f"รูปที่คล้ายที่ย้ายแล้ว: {self.stats['similar_moved']}")
+        self.move_failed_var.set(f"ย้ายไม่สำเร็จ: {self.stats['move_failed']}")
+        self.timing_var.set(self.metrics.format_summary())
         
         # Update progress bar
         self.progress["value"] = progress_percent
@@ -497,17 +2541,14 @@ class YOLOImageSimilaritySorter:
             return
             
         self.is_running = True
+        with self._speculation_lock:
+            self._speculation_generation += 1
+        self.watch_mode = self.watch_var.get()
+        self.recursive = self.recursive_var.get()
+        self.cluster_prepass = self.cluster_var.get()
             
         # Create target folders
-        self.target_folders = {
-            'car': os.path.join(self.folder_path, 'car'),
-            'not_car': os.path.join(self.folder_path, 'not_car'),
-            'person': os.path.join(self.folder_path, 'person'),
-            'car_auto': os.path.join(self.folder_path, 'car_auto')
-        }
-        
-        for folder in self.target_folders.values():
-            os.makedirs(folder, exist_ok=True)
+        self.target_folders = make_target_folders(self.folder_path)
         
         # Lock both start buttons to prevent multiple starts
         self.start_button.config(state=tk.DISABLED)
@@ -518,71 +2559,324 @@ class YOLOImageSimilaritySorter:
         # Start processing in a separate thread
         threading.Thread(target=self._sorting_thread, daemon=True).start()
     
+    def _preload_model(self):
+        """โหลดและ warm-up โมเดลตั้งแต่เปิดโปรแกรม"""
+        try:
+            ModelManager.get(self.model_path)
+            self.log(f"โหลดโมเดลล่วงหน้าสำเร็จ (device: {ModelManager.select_device()})", "success")
+        except Exception as e:
+            # ไม่ต้องแจ้งเป็น error ตรงนี้ จะลองโหลดใหม่ตอนกดเริ่ม
+            self.log(f"โหลดโมเดลล่วงหน้าไม่สำเร็จ (จะลองใหม่ตอนเริ่ม): {e}", "info")
+
     def _sorting_thread(self):
         """Function for working in a separate thread"""
         # Load YOLOv8 model
         try:
-            self.log("กำลังโหลดโมเดล YOLOv8...", "info")
-            self.model = YOLO('best-cls-v2.pt', ).to(0)
-            self.log("โหลดโมเดลสำเร็จ", "success")
+            if ModelManager.is_loaded(self.model_path):
+                self.model = ModelManager.get(self.model_path)
+                self.log("ใช้โมเดลที่โหลดไว้แล้ว", "info")
+            else:
+                self.log("กำลังโหลดโมเดล YOLOv8...", "info")
+                self.model = ModelManager.get(self.model_path)
+                self.log("โหลดโมเดลสำเร็จ", "success")
+        except Exception as e:
+            self.log(f"ข้อผิดพลาดในการโหลดโมเดล: {e}", "error")
+            self.is_running = False
+            self.ui.call(messagebox.showerror, "ข้อผิดพลาด", f"ไม่สามารถโหลดโมเดลได้: {e}")
+            self.ui.call(self.reset_controls)
+            return
+            
+        self.open_prediction_cache()
+
+        self.metrics.reset()
+        self.classifier = BatchClassifier(self.model, 1, 1, 1, cache=self.prediction_cache,
+                                          metrics=self.metrics)
+        self.hash_index = None
+        self.clusters = None
+        with self._speculation_lock:
+            self._predictions = {}
+            self._speculative_search = None
+        self._move_log = []
+        self.current_index = 0
+        if self.mode in ("not_car_auto", "car_auto"):
+            # โหมดอัตโนมัติไม่มีคนตัดสินใจ → ประมวลผลเป็น batch ใน thread นี้เลย
+            # ระหว่างที่ยังไล่รายการไฟล์ไม่เสร็จ
+            self._auto_sorting_loop()
+            self.ui.call(self.finish_sorting)
+            return
+
+        # Collect all image files in the folder
+        self.collect_image_files()
+        
+        if not self.image_files:
+            self.log("ไม่พบไฟล์ภาพในโฟลเดอร์", "warning")
+            self.is_running = False
+            self.ui.call(messagebox.showinfo, "ข้อมูล", "ไม่พบไฟล์ภาพในโฟลเดอร์ที่เลือก")
+            self.ui.call(self.reset_controls)
+            return
+            
+        # Update statistics - เพิ่ม 'skipped' ในนี้ด้วย (หรือใช้สถิติเดิมถ้าทำต่อจาก session ที่ค้างไว้)
+        done = self.open_session_journal()
+        discovered = list(self.image_files)  # ทุกไฟล์ที่อยู่ในโฟลเดอร์ (รวมที่ทำไปแล้วใน session ก่อน)
+        if done:
+            self.image_files = WorkingSet(p for p in self.image_files
+                                          if os.path.relpath(p, self.folder_path) not in done)
+            self.log(f"เหลือไฟล์ที่ต้องทำต่อ {len(self.image_files)} ไฟล์", "info")
+        self.stats['total'] += len(self.image_files)
+        self.request_stats_update()
+
+        self.open_feature_index(discovered)
+        threading.Thread(target=self._build_hash_index_thread,
+                         args=(list(self.image_files),), daemon=True).start()
+
+        # Start processing images one by one (process_next_image ทำงานใน Tk thread)
+        self.ui.call(self.process_next_image)
+
+    def _auto_sorting_loop(self):
+        """ประมวลผลโหมด Not Car Auto / Car Auto ทั้งโฟลเดอร์แบบ batch
+
+        ไฟล์ถูกส่งเข้า classifier ทันทีที่ scandir เจอ ถ้าเปิด watch จะรอไฟล์ใหม่ต่อจนกว่าจะกดหยุด
+        """
+        done = self.open_session_journal()
+        self.request_stats_update()
+        self.image_files = WorkingSet()
+
+        scanner = FolderScanner(self.folder_path, self.watch_interval, skip=done,
+                                recursive=self.recursive, exclude=self.target_folders.values())
+        if self.watch_mode:
+            self.log("เฝ้าดูไฟล์ใหม่ในโฟลเดอร์ (กดหยุดเพื่อเลิก)", "info")
+            source = scanner.watch(lambda: self.is_running)
+        else:
+            self.log("กำลังค้นหาไฟล์ภาพ...", "info")
+            source = scanner.scan()
+
+        def discovered():
+            iterator = iter(source)
+            while True:
+                started = time.perf_counter()
+                img_path = next(iterator, None)
+                if img_path is None:
+                    return
+                if not self.watch_mode:
+                    # watch mode รวมเวลารอไฟล์ใหม่ ไม่นับเป็นเวลา scan
+                    self.metrics.record('scan', time.perf_counter() - started)
+                self.image_files.append(img_path)
+                self.stats['total'] += 1
+                yield img_path
+
+        classifier = BatchClassifier(self.model, self.batch_size, self.prefetch_depth,
+                                     cache=self.prediction_cache, metrics=self.metrics)
+        batch_counts = {'moved': 0, 'skipped': 0, 'errors': 0}
+        batch_start = self.current_index
+
+        for img_path, class_name, confidence, error in classifier.classify(discovered()):
+            if not self.is_running:
+                break
+
+            if error is not None:
+                filename = os.path.basename(img_path)
+                self.log(f"ข้อผิดพลาดในการประมวลผลไฟล์ {filename}: {error}", "error")
+                batch_counts['errors'] += 1
+            else:
+                try:
+                    if self.apply_auto_rule(img_path, class_name, confidence):
+                        batch_counts['moved'] += 1
+                    else:
+                        batch_counts['skipped'] += 1
+                except Exception as e:
+                    filename = os.path.basename(img_path)
+                    self.log(f"ข้อผิดพลาดในการย้ายไฟล์ {filename}: {e}", "error")
+                    self.stats['move_failed'] += 1
+                    batch_counts['errors'] += 1
+
+            self.current_index += 1
+
+            # สรุป log และสถิติทีละ batch แทนทีละรูป (หรือเมื่อทำทันไฟล์ที่เจอแล้ว)
+            if self.current_index - batch_start >= self.batch_size or self.current_index >= len(self.image_files):
+                message = (f"ประมวลผลรูปที่ {batch_start+1}-{self.current_index}/{len(self.image_files)}: "
+                           f"ย้าย {batch_counts['moved']}, ข้าม {batch_counts['skipped']}, ผิดพลาด {batch_counts['errors']}")
+                self.log(message, "info")
+                self.request_stats_update()
+                self.flush_journal()
+                batch_counts = {'moved': 0, 'skipped': 0, 'errors': 0}
+                batch_start = self.current_index
+                # ไฟล์ที่ทำแล้วไม่ต้องจำ path ไว้ (watch mode รันได้นานไม่จำกัด)
+                self.image_files.forget_before(self.current_index)
+
+        if not self.image_files and not done:
+            self.log("ไม่พบไฟล์ภาพในโฟลเดอร์", "warning")
+
+    def apply_auto_rule(self, img_path, class_name, confidence):
+        """ใช้กฎของโหมดอัตโนมัติกับผลทำนาย คืนค่า path ปลายทาง หรือ None ถ้าข้าม"""
+        started = time.perf_counter()
+        target_path = apply_auto_rule(self.mode, img_path, class_name, confidence, self.target_folders,
+                                      self.stats, self.target_class_keywords, self.folder_path)
+        if target_path:
+            self.metrics.record('move', time.perf_counter() - started)
+            self.journal_record(img_path, target_path, class_name, confidence, 'auto_not_car', 'processed')
+        else:
+            self.journal_record(img_path, None, class_name, confidence, 'skipped', 'processed')
+        return target_path
+
+    def open_prediction_cache(self):
+        """เปิด PredictionCache ของโมเดลปัจจุบัน (ทำงานต่อได้แม้เปิดไม่สำเร็จ)"""
+        try:
+            checksum = ModelManager.checksum(self.model_path)
+            if self.prediction_cache is None or self.prediction_cache.model_checksum != checksum:
+                if self.prediction_cache is not None:
+                    self.prediction_cache.close()
+                self.prediction_cache = PredictionCache.open_default(checksum)
+        except Exception as e:
+            self.prediction_cache = None
+            self.log(f"ไม่สามารถเปิด cache ผลทำนายได้: {e}", "warning")
+
+    def output_path(self, img_path, category, create=True):
+        """path ปลายทางของไฟล์ในโฟลเดอร์ผลลัพธ์ (คงโครงสร้างโฟลเดอร์ย่อยของ input)"""
+        return mirrored_path(img_path, self.folder_path, self.target_folders[category], create)
+
+    def open_session_journal(self):
+        """เปิด journal ของโฟลเดอร์และตั้งค่า self.stats
+
+        ถ้ามี session โหมดเดียวกันที่ยังไม่จบ คืนชุด path (สัมพัทธ์กับโฟลเดอร์) ที่ทำไปแล้ว ไม่งั้นคืนชุดว่าง
+        stats['total'] นับเฉพาะไฟล์ที่ทำไปแล้ว ผู้เรียกต้องบวกจำนวนไฟล์ที่เหลือเอง
+        """
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = SessionJournal(self.folder_path)
+
+        session = self.journal.load()
+        try:
+            if session is not None and session['mode'] == self.mode:
+                self.stats = session['stats']
+                self.journal.resume()
+                self.log(f"ทำต่อจาก session เดิม: ดำเนินการแล้ว {self.stats['processed']} ไฟล์", "info")
+                return session['done']
+            self.journal.begin(self.mode)
+        except OSError as e:
+            # บันทึก journal ไม่ได้ (เช่น โฟลเดอร์อ่านอย่างเดียว) ก็ยังคัดแยกต่อได้
+            self.journal = None
+            self.log(f"ไม่สามารถเปิด session journal ได้: {e}", "warning")
+        self.stats = new_stats()
+        return set()
+
+    def journal_record(self, src, dst, class_name, confidence, *counters):
+        """บันทึกการตัดสินใจลง session journal (ถ้ามี)"""
+        if self.journal is not None:
+            self.journal.record(src, dst, class_name, confidence, *counters)
+
+    def flush_journal(self, sync=False):
+        if self.journal is None:
+            return
+        try:
+            self.journal.flush(sync)
+        except OSError as e:
+            self.log(f"ไม่สามารถบันทึก session journal ได้: {e}", "warning")
+
+    def flush_prediction_cache(self):
+        """บันทึกผลทำนายที่ค้างอยู่ลงดิสก์"""
+        if self.prediction_cache is None:
+            return
+        try:
+            self.prediction_cache.flush()
         except Exception as e:
-            self.log(f"ข้อผิดพลาดในการโหลดโมเดล: {e}", "error")
-            messagebox.showerror("ข้อผิดพลาด", f"ไม่สามารถโหลดโมเดลได้: {e}")
-            self.is_running = False
-            self.root.after(0, lambda: self.start_button.config(state=tk.NORMAL))
-            self.root.after(0, lambda: self.not_car_auto_button.config(state=tk.NORMAL))
-            self.root.after(0, lambda: self.car_auto_button.config(state=tk.NORMAL))
-            self.root.after(0, lambda: self.stop_button.config(state=tk.DISABLED))
+            print(f"ไม่สามารถบันทึก cache ผลทำนายได้: {e}", file=sys.stderr)
+
+    def open_feature_index(self, discovered):
+        """เปิด feature index ของโฟลเดอร์ปัจจุบัน (ใช้ตัวเดิมถ้าเป็นโฟลเดอร์เดียวกัน)
+
+        ลบ feature ของไฟล์ที่ไม่อยู่ใน discovered (ทุกไฟล์ที่สแกนเจอ ไม่ใช่เฉพาะที่เหลือหลังทำต่อ)
+        """
+        db_path = os.path.join(self.folder_path, FeatureIndex.FILENAME)
+        if self.feature_index is None or self.feature_index.db_path != db_path:
+            if self.feature_index is not None:
+                self.feature_index.close()
+            self.feature_index = FeatureIndex(db_path, metrics=self.metrics)
+
+        removed = self.feature_index.prune(discovered)
+        if removed:
+            self.log(f"ลบ feature ของไฟล์ที่ไม่อยู่ในโฟลเดอร์แล้ว {removed} รายการ", "info")
+
+    def _build_hash_index_thread(self, image_files):
+        """คำนวณ feature ของทุกรูปลง index แล้วสร้าง HammingIndex สำหรับกรองรูปที่อาจคล้าย"""
+        hash_index = HammingIndex()
+        indexed = []  # (img_path, features) สำหรับจัดกลุ่มล่วงหน้า
+        try:
+            for img_path, features in self.feature_index.get_many(image_files, self.feature_extractor,
+                                                                  with_orb=not self.cascade_scoring):
+                if not self.is_running:
+                    return
+                hash_index.add(img_path, features['avg_hash'], features['d_hash'])
+                if self.cluster_prepass:
+                    indexed.append((img_path, features))
+        except Exception as e:
+            self.log(f"ข้อผิดพลาดในการสร้าง hash index: {e}", "error")
             return
-            
-        # Collect all image files in the folder
-        self.collect_image_files()
-        
-        if not self.image_files:
-            self.log("ไม่พบไฟล์ภาพในโฟลเดอร์", "warning")
-            messagebox.showinfo("ข้อมูล", "ไม่พบไฟล์ภาพในโฟลเดอร์ที่เลือก")
-            self.is_running = False
-            self.root.after(0, lambda: self.start_button.config(state=tk.NORMAL))
-            self.root.after(0, lambda: self.not_car_auto_button.config(state=tk.NORMAL))
-            self.root.after(0, lambda: self.stop_button.config(state=tk.DISABLED))
+
+        self.feature_index.flush()
+        self.hash_index = hash_index
+        self.log(f"สร้าง hash index สำหรับค้นหารูปคล้ายแล้ว ({hash_index.size} รูป)", "info")
+
+        if self.cluster_prepass and self.is_running:
+            self.build_clusters(indexed)
+
+    def build_clusters(self, indexed):
+        """จัดกลุ่มรูปคล้ายทั้งโฟลเดอร์ครั้งเดียว (เฉพาะรูปที่ยังไม่ถูกย้าย)
+
+        member ของแต่ละกลุ่มถูกยืนยันด้วย score_candidates (คะแนนเดียวกับการค้นหาแบบ sliding window)
+        threshold และคะแนนที่แสดงจึงมีความหมายเหมือนกันทั้งสองแบบ
+        """
+        indexed = [(path, features) for path, features in indexed if self.image_files.is_live(path)]
+        if not indexed:
             return
-            
-        # Update statistics - เพิ่ม 'skipped' ในนี้ด้วย
-        self.stats = {
-            'total': len(self.image_files),
-            'processed': 0,
-            'car': 0,
-            'not_car': 0,
-            'person': 0,
-            'auto_not_car': 0,
-            'similar_moved': 0,
-            'skipped': 0
-        }
-        self.root.after(0, self.update_stats)
-        
-        # Start processing images one by one
-        self.current_index = 0
-        self.process_next_image()
-        
+        threshold = self.threshold
+        clusters = cluster_near_duplicates(stack_features([features for _, features in indexed]), threshold)
+
+        members = {}
+        grouped = 0
+        for leader, cluster in clusters:
+            if not self.is_running:
+                return
+            ref_path, ref = indexed[leader]
+            confirmed = []
+            if cluster:
+                paths = [indexed[i][0] for i, _ in cluster]
+                ref_descriptors = self.orb_matcher.descriptors(ref_path, self.feature_index.descriptors)
+                scores = self.score_candidates(ref, ref_descriptors, paths,
+                                               [indexed[i][1] for i, _ in cluster], threshold)
+                confirmed = [(path, score) for path, score in zip(paths, scores.tolist())
+                             if score >= threshold]
+            members[ref_path] = confirmed
+            grouped += len(confirmed)
+        self.clusters = {'threshold': threshold, 'members': members}
+        self.log(f"จัดกลุ่มรูปคล้ายแล้ว: {len(clusters)} กลุ่ม "
+                 f"(รูปที่อยู่ในกลุ่มเดียวกับรูปอื่น {grouped} รูป)", "info")
+
+    def cluster_members(self, ref_img_path, threshold):
+        """รูปในกลุ่มของรูปต้นแบบจากการจัดกลุ่มล่วงหน้า คืน None ถ้าใช้ไม่ได้ (ต้องค้นหาแบบ sliding window)"""
+        clusters = self.clusters
+        if clusters is None or clusters['threshold'] != threshold:
+            return None
+        members = clusters['members'].get(ref_img_path)
+        if members is None:
+            # ไม่ใช่รูปต้นแบบของกลุ่ม (เช่น อยู่ในกลุ่มที่ถูกข้าม)
+            return None
+        return [(path, score) for path, score in members if self.image_files.is_live(path)]
+
     def collect_image_files(self):
         """Collect all image files in the folder"""
-        valid_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp']
-        
         self.log("กำลังค้นหาไฟล์ภาพ...", "info")
         
-        self.image_files = []
-        for file in os.listdir(self.folder_path):
-            # แก้ตรงนี้: ใช้ os.path.normpath เพื่อมาตรฐานเส้นทาง
-            file_path = os.path.normpath(os.path.join(self.folder_path, file))
-            
-            if os.path.isfile(file_path) and any(file.lower().endswith(ext) for ext in valid_extensions):
-                if not any(target_folder in file_path for target_folder in self.target_folders.values()):
-                    self.image_files.append(file_path)
+        started = time.perf_counter()
+        self.image_files = WorkingSet(collect_image_paths(self.folder_path, self.recursive,
+                                                          exclude=self.target_folders.values()))
+        self.metrics.record('scan', time.perf_counter() - started, len(self.image_files))
                         
         self.log(f"พบไฟล์ภาพทั้งหมด {len(self.image_files)} ไฟล์", "success")
         
     def process_next_image(self):
         """Process the next image"""
+        # ข้ามไฟล์ที่ถูกย้ายไปแล้ว (เช่น เป็นรูปคล้ายของรูปต้นแบบก่อนหน้า)
+        self.current_index = self.image_files.next_live(self.current_index)
         if not self.is_running or self.current_index >= len(self.image_files) or not self.image_files:
             self.finish_sorting()
             return
@@ -590,26 +2884,46 @@ class YOLOImageSimilaritySorter:
         img_path = self.image_files[self.current_index]
         filename = os.path.basename(img_path)
         
-        self.log(f"กำลังประมวลผล ({self.current_index+1}/{len(self.image_files)}): {filename}")
+        total = len(self.image_files)
+        remaining = self.image_files.remaining(self.current_index)
+        self.log(f"กำลังประมวลผล ({total - remaining + 1}/{total}, เหลือ {remaining} รูป): {filename}")
         
+        prediction = self._predictions.pop(img_path, None)
+        if prediction is not None:
+            # จำแนกไว้แล้วล่วงหน้าระหว่างที่ผู้ใช้ตัดสินใจรูปก่อนหน้า
+            self._on_image_classified(img_path, prediction[0], prediction[1], None)
+        else:
+            # Predict with model (classification) นอก Tk thread (อาจต้องรอ inference_lock ของงานล่วงหน้า)
+            self.classify_executor.submit(self._classify_current_image, img_path)
+
+    def _classify_current_image(self, img_path):
+        """จำแนกรูปปัจจุบันใน classify_executor แล้วส่งผลกลับ Tk thread"""
         try:
-            # Predict with model (classification)
-            results = self.model(img_path)
-            result = results[0]
-            
-            # Get the class with highest confidence
-            class_id = result.probs.top1
-            class_name = result.names[class_id]
-            confidence = result.probs.top1conf.item()
+            class_name, confidence, error = self.classifier.classify_one(img_path)
+        except Exception as e:
+            class_name, confidence, error = None, None, str(e)
+        self.ui.call(self._on_image_classified, img_path, class_name, confidence, error)
+
+    def _on_image_classified(self, img_path, class_name, confidence, error):
+        """ทำงานต่อจากผลทำนายของรูปปัจจุบัน (Tk thread)"""
+        # ผลที่มาถึงหลังกดหยุดหรือเริ่มรอบใหม่ไปแล้ว ไม่ใช่ของรูปปัจจุบัน
+        if (not self.is_running or self.current_index >= len(self.image_files)
+                or self.image_files[self.current_index] != img_path):
+            return
+        filename = os.path.basename(img_path)
+        try:
+            if error is not None:
+                raise RuntimeError(error)
+            self._current_prediction = (class_name, confidence)
             
             # Check if the predicted class is in our target classes
-            is_target_class = any(keyword.lower() in class_name.lower() for keyword in self.target_class_keywords)
+            is_target = is_target_class(class_name, self.target_class_keywords)
             
             self.log(f"  คลาสที่ทำนาย: {class_name}, ความมั่นใจ: {confidence:.4f}")
             
             if self.mode == "normal":
                 # โหมดปกติ
-                if is_target_class:
+                if is_target:
                     # If it's a target class, find similar images
                     self.log(f"  กำลังค้นหารูปที่คล้ายกัน...", "info")
                     
@@ -618,81 +2932,31 @@ class YOLOImageSimilaritySorter:
                     self.unselected_images = set()
                     
                     # Find similar images in a separate thread
-                    self.root.after(0, lambda: self.find_similar_images(img_path, class_name, confidence))
+                    self.find_similar_images(img_path, class_name, confidence)
                 else:
                     # If not a target class, move to not_car folder automatically
-                    target_path = os.path.join(self.target_folders['not_car'], filename)
-                    shutil.move(img_path, target_path)
+                    target_path = self.output_path(img_path, 'not_car')
+                    with self.metrics.measure('move'):
+                        move_file(img_path, target_path)
+                    self.record_move(img_path)
+                    self.journal_record(img_path, target_path, class_name, confidence, 'auto_not_car', 'processed')
+                    self.flush_journal(sync=True)
                     self.log(f"  ย้ายไปยังโฟลเดอร์ not_car โดยอัตโนมัติ", "info")
                     
                     # Update statistics
                     self.stats['processed'] += 1
                     self.stats['auto_not_car'] += 1
-                    self.root.after(0, self.update_stats)
-                    
-                    # Process next image
-                    self.current_index += 1
-                    self.root.after(100, self.process_next_image)
-                    
-            elif self.mode == "not_car_auto":
-                # โหมด Not Car Auto
-                if is_target_class:
-                    # ถ้าเจอรถ → Skip ไปเลย
-                    self.log(f"  โหมด Not Car Auto: เจอรถ → Skip", "warning")
-                    
-                    # Update statistics
-                    self.stats['processed'] += 1
-                    self.stats['skipped'] += 1
-                    self.root.after(0, self.update_stats)
-                    
-                    # Process next image
-                    self.current_index += 1
-                    self.root.after(100, self.process_next_image)
-                else:
-                    # ถ้าไม่เจอรถ → ย้ายไป not_car ทันที
-                    target_path = os.path.join(self.target_folders['not_car'], filename)
-                    shutil.move(img_path, target_path)
-                    self.log(f"  โหมด Not Car Auto: ไม่เจอรถ → ย้ายไป not_car", "success")
-                    
-                    # Update statistics
-                    self.stats['processed'] += 1
-                    self.stats['auto_not_car'] += 1
-                    self.root.after(0, self.update_stats)
+                    self.request_stats_update()
                     
                     # Process next image
                     self.current_index += 1
-                    self.root.after(100, self.process_next_image)
-
-            elif self.mode == "car_auto":
-                # โหมด Car Auto
-                if is_target_class and confidence > 0.9999:
-                    # ถ้าเจอรถและ confidence = 1.0 → ย้ายไป car_auto
-                    target_path = os.path.join(self.target_folders['car_auto'], filename)
-                    shutil.move(img_path, target_path)
-                    self.log(f"  โหมด Car Auto: เจอรถ conf=1.0 → ย้ายไป car_auto", "success")
-                    
-                    # Update statistics
-                    self.stats['processed'] += 1
-                    self.stats['auto_not_car'] += 1  # ใช้ตัวแปรเดิม
-                    self.root.after(0, self.update_stats)
-                else:
-                    # ถ้าไม่เจอรถ หรือ confidence < 1.0 → Skip
-                    self.log(f"  โหมด Car Auto: ไม่เจอรถ หรือ conf<1.0 → Skip", "warning")
-                    
-                    # Update statistics
-                    self.stats['processed'] += 1
-                    self.stats['skipped'] += 1
-                    self.root.after(0, self.update_stats)
-                
-                # Process next image
-                self.current_index += 1
-                self.root.after(100, self.process_next_image)
+                    self.ui.call(self.process_next_image)
                     
         except Exception as e:
             self.log(f"ข้อผิดพลาดในการประมวลผลไฟล์ {filename}: {e}", "error")
             # Skip to next image
             self.current_index += 1
-            self.root.after(100, self.process_next_image)
+            self.ui.call(self.process_next_image)
     
     def find_similar_images(self, img_path, class_name, confidence):
         """ค้นหารูปที่คล้ายกับรูปต้นแบบ"""
@@ -710,211 +2974,238 @@ class YOLOImageSimilaritySorter:
     def _find_similar_images_thread(self, ref_img_path, class_name, confidence):
         """Thread สำหรับค้นหารูปที่คล้ายกัน (แบบ sliding window 10 รูปต่อรอบ)"""
         try:
-            ref_image = cv2.imread(ref_img_path)
-            if ref_image is None:
-                self.root.after(0, lambda: self.log(f"ไม่สามารถอ่านรูปต้นแบบได้", "error"))
-                self.current_index += 1
-                self.root.after(0, self.process_next_image)
-                return
+            # ใช้ผลที่ค้นหาไว้ล่วงหน้าระหว่างที่ผู้ใช้ตัดสินใจรูปก่อนหน้า (ถ้ายังใช้ได้)
+            similar_images = self._take_speculative_search(ref_img_path)
+            if similar_images is not None:
+                self.log(f"  ใช้ผลการค้นหารูปคล้ายที่คำนวณไว้ล่วงหน้า", "info")
+            else:
+                similar_images, _ = self.search_similar_images(ref_img_path, self.threshold, self.log)
 
-            ref_image = cv2.resize(ref_image, (128, 128))
-            ref_gray = cv2.cvtColor(ref_image, cv2.COLOR_BGR2GRAY)
-
-            # 1. Histogram
-            ref_hsv = cv2.cvtColor(ref_image, cv2.COLOR_BGR2HSV)
-            histSize = [8, 8]
-            ranges = [0, 180, 0, 256]
-            channels = [0, 1]
-            ref_hist = cv2.calcHist([ref_hsv], channels, None, histSize, ranges)
-            cv2.normalize(ref_hist, ref_hist, 0, 1, cv2.NORM_MINMAX)
-
-            # 2. Average Hash
-            small_img = cv2.resize(ref_gray, (8, 8))
-            avg = small_img.mean()
-            ref_avg_hash = small_img >= avg
-
-            # 3. Difference Hash
-            resize_img = cv2.resize(ref_gray, (9, 8))
-            ref_d_hash = np.zeros((8, 8), dtype=np.bool_)
-            for i in range(8):
-                for j in range(8):
-                    ref_d_hash[i, j] = resize_img[i, j] > resize_img[i, j + 1]
-
-            # 4. ORB
-            orb = cv2.ORB_create(nfeatures=1000)
-            _, ref_features = orb.detectAndCompute(ref_gray, None)
-
-            similar_images = []
-            
-            # หา index ของรูปต้นแบบ
-            ref_index = -1
-            for i, img_path in enumerate(self.image_files):
-                if os.path.abspath(img_path) == os.path.abspath(ref_img_path):
-                    ref_index = i
-                    break
-            
-            if ref_index == -1:
-                self.root.after(0, lambda: self.log(f"ไม่พบรูปต้นแบบในรายการ", "error"))
-                self.current_index += 1
-                self.root.after(0, self.process_next_image)
-                return
+            self.similar_images = similar_images
+            self.log(f"พบรูปที่คล้ายกันทั้งหมด {len(similar_images)} รูป", "success")
+            self.ui.call(self.show_decision_ui, ref_img_path, class_name, confidence, similar_images)
 
-            # เริ่มหารูปที่คล้ายกันแบบ sliding window
-            window_size = 500
-            start_index = ref_index + 1  # เริ่มจากรูปถัดไป
-            
-            while start_index < len(self.image_files):
-                # กำหนดขอบเขตของ window ปัจจุบัน
-                end_index = min(start_index + window_size, len(self.image_files))
-                current_window = self.image_files[start_index:end_index]
-                
-                self.root.after(0, lambda s=start_index, e=end_index: 
-                            self.log(f"  กำลังตรวจสอบรูปที่ {s+1}-{e} จากทั้งหมด {len(self.image_files)} รูป", "info"))
-                
-                # ตัวแปรเก็บว่าเจอรูปคล้ายใน window นี้หรือไม่
-                found_similar_in_window = False
-                
-                # ตรวจสอบรูปใน window ปัจจุบัน
-                for img_path in current_window:
-                    try:
-                        img = cv2.imread(img_path)
-                        if img is None:
-                            continue
-
-                        img = cv2.resize(img, (128, 128))
-                        img_hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-                        img_hist = cv2.calcHist([img_hsv], channels, None, histSize, ranges)
-                        cv2.normalize(img_hist, img_hist, 0, 1, cv2.NORM_MINMAX)
-                        hist_similarity = cv2.compareHist(ref_hist, img_hist, cv2.HISTCMP_CORREL)
-                        hist_similarity = max(0, hist_similarity)
-
-                        img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-                        small_img = cv2.resize(img_gray, (8, 8))
-                        avg = small_img.mean()
-                        img_avg_hash = small_img >= avg
-                        avg_hash_similarity = np.mean(ref_avg_hash == img_avg_hash)
-
-                        resize_img = cv2.resize(img_gray, (9, 8))
-                        img_d_hash = np.zeros((8, 8), dtype=np.bool_)
-                        for i in range(8):
-                            for j in range(8):
-                                img_d_hash[i, j] = resize_img[i, j] > resize_img[i, j + 1]
-                        d_hash_similarity = np.mean(ref_d_hash == img_d_hash)
-
-                        # ORB feature matching
-                        feature_similarity = 0
-                        if ref_features is not None and ref_features.shape[0] > 0:
-                            _, img_features = orb.detectAndCompute(img_gray, None)
-                            if img_features is not None and img_features.shape[0] > 0:
-                                bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
-                                matches = bf.match(ref_features, img_features)
-                                if len(matches) > 0:
-                                    matches = sorted(matches, key=lambda x: x.distance)
-                                    good_matches = [m for m in matches if m.distance < 50]
-                                    if len(good_matches) > 0:
-                                        feature_similarity = len(good_matches) / max(len(matches), 1)
-
-                        if feature_similarity <= 0:
-                            similarity_score = (
-                                hist_similarity * 0.5 +
-                                avg_hash_similarity * 0.2 +
-                                d_hash_similarity * 0.3
-                            )
-                        else:
-                            similarity_score = (
-                                hist_similarity * 0.4 +
-                                avg_hash_similarity * 0.2 +
-                                d_hash_similarity * 0.3 +
-                                feature_similarity * 0.1
-                            )
-
-                        if similarity_score >= self.threshold:
-                            similar_images.append((img_path, similarity_score))
-                            found_similar_in_window = True
-                            
-                            # แสดง log เมื่อเจอรูปคล้าย
-                            filename = os.path.basename(img_path)
-                            self.root.after(0, lambda f=filename, s=similarity_score: 
-                                        self.log(f"    เจอรูปคล้าย: {f} (ความคล้าย: {s:.2%})", "success"))
-
-                    # เปลี่ยนเป็น:
-                    except Exception as e:
-                        # ใช้ try-except เพื่อป้องกัน error จาก os.path.basename
-                        try:
-                            filename = os.path.basename(img_path)
-                        except:
-                            filename = "unknown file"
+        except LookupError as e:
+            self.log(str(e), "error")
+            self.ui.call(self.skip_to_next_image)
+        except Exception as e:
+            self.log(f"ข้อผิดพลาดในการค้นหารูปที่คล้ายกัน: {e}", "error")
+            self.ui.call(self.skip_to_next_image)
+
+    def skip_to_next_image(self):
+        """ข้ามรูปปัจจุบันไปยังรูปถัดไป (Tk thread)"""
+        self.current_index += 1
+        self.process_next_image()
+
+    def search_similar_images(self, ref_img_path, threshold, log=None):
+        """ค้นหารูปที่คล้ายกับรูปต้นแบบแบบ sliding window
+
+        คืนค่า (similar_images, (start, end)) โดย (start, end) คือช่วง index ที่ตรวจไปแล้ว
+        โยน LookupError ถ้าอ่านรูปต้นแบบไม่ได้หรือไม่พบในรายการ
+        """
+        log = log or (lambda message, level="normal": None)
+
+        # ใช้ผลการจัดกลุ่มล่วงหน้า (ถ้ามี) ไม่ต้อง decode หรือเทียบรูปใหม่
+        ref_index = self.image_files.index_of(ref_img_path)
+        members = self.cluster_members(ref_img_path, threshold)
+        if members is not None and ref_index != -1:
+            log(f"  ใช้กลุ่มรูปคล้ายที่จัดไว้ล่วงหน้า ({len(members)} รูป)", "info")
+            end_index = max([self.image_files.index_of(path) for path, _ in members] + [ref_index]) + 1
+            return members, (ref_index, end_index)
+
+        # feature ของรูปต้นแบบ (จาก index ถ้ามี ไม่ต้อง decode ซ้ำ)
+        ref = self.feature_index.get(ref_img_path)
+        if ref is None:
+            raise LookupError("ไม่สามารถอ่านรูปต้นแบบได้")
+        ref_descriptors = self.orb_matcher.descriptors(ref_img_path, self.feature_index.descriptors)
+
+        similar_images = []
+        
+        if ref_index == -1:
+            raise LookupError("ไม่พบรูปต้นแบบในรายการ")
+
+        # กรองล่วงหน้าด้วย HammingIndex (ถ้าสร้างเสร็จแล้ว) รูปที่ hash ห่างเกินไม่มีทางผ่าน threshold
+        candidate_paths = None
+        if self.hash_index is not None:
+            candidate_paths = self.hash_index.query(ref['avg_hash'], ref['d_hash'],
+                                                    hash_distance_limit(threshold))
+
+        # เริ่มหารูปที่คล้ายกันแบบ sliding window
+        window_size = 500
+        start_index = ref_index + 1  # เริ่มจากรูปถัดไป
+        end_index = start_index
+        
+        while start_index < len(self.image_files):
+            # กำหนดขอบเขตของ window ปัจจุบัน
+            end_index = min(start_index + window_size, len(self.image_files))
+            current_window = self.image_files.live(start_index, end_index)
+            if candidate_paths is not None:
+                current_window = [p for p in current_window if p in candidate_paths]
+            
+            log(f"  กำลังตรวจสอบรูปที่ {start_index+1}-{end_index} จากทั้งหมด {len(self.image_files)} รูป", "info")
+            
+            # ตัวแปรเก็บว่าเจอรูปคล้ายใน window นี้หรือไม่
+            found_similar_in_window = False
+            
+            # ดึง feature ของรูปใน window ปัจจุบัน (จาก index)
+            # รูปที่ยังไม่อยู่ใน index จะถูกคำนวณแบบขนานด้วย process pool
+            window_paths = []
+            window_features = []
+            for img_path, features in self.feature_index.get_many(current_window, self.feature_extractor,
+                                                                  with_orb=not self.cascade_scoring):
+                window_paths.append(img_path)
+                window_features.append(features)
+
+            # คำนวณคะแนนทั้ง window ในครั้งเดียว
+            if window_features:
+                started = time.perf_counter()
+                scores = self.score_candidates(ref, ref_descriptors, window_paths, window_features, threshold)
+                self.metrics.record('similarity', time.perf_counter() - started, len(window_paths))
+                for img_path, similarity_score in zip(window_paths, scores.tolist()):
+                    if similarity_score >= threshold:
+                        similar_images.append((img_path, similarity_score))
+                        found_similar_in_window = True
                         
-                        error_msg = f"ข้อผิดพลาดในการประมวลผลไฟล์ {filename}: {str(e)}"
-                        self.root.after(0, lambda msg=error_msg: self.log(msg, "error"))
-                        continue
-                # ตรวจสอบว่าเจอรูปคล้ายใน window นี้หรือไม่
-                if found_similar_in_window:
-                    self.root.after(0, lambda s=start_index, e=end_index: 
-                                self.log(f"  เจอรูปคล้ายในรูปที่ {s+1}-{e}, ดำเนินการหาต่อ...", "info"))
-                    # เลื่อน window ไปข้างหน้า
-                    start_index = end_index
-                else:
-                    # ไม่เจอรูปคล้ายใน window นี้ หยุดการค้นหา
-                    self.root.after(0, lambda s=start_index, e=end_index: 
-                                self.log(f"  ไม่เจอรูปคล้ายในรูปที่ {s+1}-{e}, หยุดการค้นหา", "warning"))
-                    break
+                        # แสดง log เมื่อเจอรูปคล้าย
+                        log(f"    เจอรูปคล้าย: {os.path.basename(img_path)} (ความคล้าย: {similarity_score:.2%})", "success")
 
-            self.similar_images = similar_images
-            self.root.after(0, lambda: self.log(f"พบรูปที่คล้ายกันทั้งหมด {len(similar_images)} รูป", "success"))
-            self.root.after(0, lambda: self.show_decision_ui(ref_img_path, class_name, confidence, similar_images))
+            # ตรวจสอบว่าเจอรูปคล้ายใน window นี้หรือไม่
+            if found_similar_in_window:
+                log(f"  เจอรูปคล้ายในรูปที่ {start_index+1}-{end_index}, ดำเนินการหาต่อ...", "info")
+                # เลื่อน window ไปข้างหน้า
+                start_index = end_index
+            else:
+                # ไม่เจอรูปคล้ายใน window นี้ หยุดการค้นหา
+                log(f"  ไม่เจอรูปคล้ายในรูปที่ {start_index+1}-{end_index}, หยุดการค้นหา", "warning")
+                break
 
-        except Exception as e:
-            self.root.after(0, lambda e=e: self.log(f"ข้อผิดพลาดในการค้นหารูปที่คล้ายกัน: {e}", "error"))
-            self.current_index += 1
-            self.root.after(0, self.process_next_image)
-    
+        self.feature_index.flush()
+        return similar_images, (ref_index, end_index)
+
+    def score_candidates(self, ref, ref_descriptors, paths, features_list, threshold):
+        """คะแนนความคล้ายของรูปต้นแบบกับรูปใน paths (รวม ORB ตาม cascade_scoring) คืน array"""
+        candidates = stack_features(features_list)
+        if self.cascade_scoring:
+            # ORB (และการ decode เพื่อคำนวณ ORB) เฉพาะรูปที่ผ่าน metric ถูกๆ แล้ว
+            scores, _ = score_similarity_cascade(
+                ref, candidates, threshold,
+                lambda indices: self.orb_matcher.batch_similarity(
+                    ref_descriptors, [paths[i] for i in indices], self.feature_index.descriptors))
+            return scores
+        feature_similarity = self.orb_matcher.batch_similarity(
+            ref_descriptors, paths, self.feature_index.descriptors)
+        return score_similarity(ref, candidates, feature_similarity)
+
+    def start_speculation(self):
+        """จำแนกรูปถัดไปและค้นหารูปคล้ายล่วงหน้า ขณะที่ผู้ใช้ดูหน้าต่างตัดสินใจ"""
+        if self.mode != "normal" or not self.is_running or self.lookahead_size <= 0:
+            return
+        threading.Thread(target=self._speculation_thread,
+                         args=(self.current_index + 1, self._speculation_generation),
+                         daemon=True).start()
+
+    def _speculation_thread(self, start_index, generation):
+        """Thread สำหรับทำงานล่วงหน้า (ผลเก็บใน self._predictions และ self._speculative_search)
+
+        ผลทุกชิ้นเขียนภายใต้ _speculation_lock หลังตรวจ generation อีกครั้ง
+        ผลของรอบที่ถูกหยุดหรือเริ่มใหม่ไปแล้วจึงไม่หลุดเข้ารอบปัจจุบัน
+        """
+        def cancelled():
+            return generation != self._speculation_generation or not self.is_running
 
-    def log(self, message, level="normal"):
-        """Add a message to the log area"""
         try:
-            # ป้องกันการ recursion
-            if hasattr(self, '_logging_in_progress') and self._logging_in_progress:
+            upcoming = self.image_files.live(start_index, start_index + self.lookahead_size)
+            pending = [p for p in upcoming if p not in self._predictions]
+
+            # 1. จำแนกรูปถัดไปเป็น batch
+            classifier = BatchClassifier(self.model, self.batch_size, self.prefetch_depth,
+                                         cache=self.prediction_cache, metrics=self.metrics)
+            for img_path, class_name, confidence, error in classifier.classify(pending):
+                with self._speculation_lock:
+                    if cancelled():
+                        return
+                    if error is None:
+                        self._predictions[img_path] = (class_name, confidence)
+
+            # 2. หารูปเป้าหมายถัดไป (รูปแรกที่ต้องเปิดหน้าต่างตัดสินใจ)
+            next_target = None
+            for img_path in upcoming:
+                prediction = self._predictions.get(img_path)
+                if prediction is None:
+                    # ยังไม่รู้ผลของรูปนี้ ไม่เดาต่อ
+                    break
+                if is_target_class(prediction[0], self.target_class_keywords):
+                    next_target = img_path
+                    break
+            if next_target is None or cancelled():
                 return
-            
-            self._logging_in_progress = True
-            
-            self.log_text.config(state=tk.NORMAL)
-            
-            # Add timestamp before message
-            from datetime import datetime
-            timestamp = datetime.now().strftime("[%H:%M:%S] ")
-            self.log_text.insert(tk.END, timestamp, "info")
-            
-            # จำกัดความยาวของ message
-            if len(str(message)) > 1000:
-                message = str(message)[:1000] + "..."
-            
-            # Add message with appropriate color based on level
-            if level in ["info", "success", "warning", "error"]:
-                self.log_text.insert(tk.END, str(message) + "\n", level)
-            else:
-                self.log_text.insert(tk.END, str(message) + "\n")
-                
-            self.log_text.see(tk.END)
-            self.log_text.config(state=tk.DISABLED)
-            self.root.update_idletasks()  # ใช้ update_idletasks แทน update
-            
+
+            # 3. ค้นหารูปคล้ายของรูปเป้าหมายถัดไป
+            threshold = self.threshold
+            move_marker = len(self._move_log)
+            similar_images, scanned = self.search_similar_images(next_target, threshold)
+            with self._speculation_lock:
+                if cancelled():
+                    return
+                self._speculative_search = {
+                    'ref': next_target,
+                    'threshold': threshold,
+                    'similar_images': similar_images,
+                    'scanned': scanned,
+                    'move_marker': move_marker,
+                }
+
+            # 4. เตรียม thumbnail ของหน้าต่างถัดไป (รูปต้นแบบ + แถวแรกๆ ของรูปคล้าย)
+            self.thumbnail_executor.submit(self.load_thumbnail, next_target, REFERENCE_PREVIEW_SIZE)
+            for img_path, _ in similar_images[:self.THUMBNAIL_WARM_COUNT]:
+                self.thumbnail_executor.submit(self.load_thumbnail, img_path, ThumbnailGrid.THUMBNAIL_SIZE)
         except Exception as e:
-            print(f"Error in log function: {e}")
-        finally:
-            self._logging_in_progress = False
+            self.log(f"งานล่วงหน้าล้มเหลว: {e}\n{traceback.format_exc()}", "error")
+
+    THUMBNAIL_WARM_COUNT = 12
+
+    def load_thumbnail(self, img_path, size):
+        """thumbnail ผ่าน ThumbnailCache (ถ้าเปิด cache ไม่ได้จะ decode ไฟล์ต้นฉบับตรงๆ)"""
+        if self.thumbnail_cache is None:
+            return load_thumbnail(img_path, size)
+        return self.thumbnail_cache.get(img_path, size)
+
+    def _take_speculative_search(self, ref_img_path):
+        """คืนผลค้นหาที่ทำไว้ล่วงหน้าถ้ายังตรงกับสถานะปัจจุบัน ไม่งั้นคืน None"""
+        with self._speculation_lock:
+            speculative = self._speculative_search
+            self._speculative_search = None
+        if speculative is None or speculative['ref'] != ref_img_path:
+            return None
+        if speculative['threshold'] != self.threshold:
+            return None
+
+        # ถ้ามีไฟล์ในช่วงที่ตรวจถูกย้ายไปหลังจากค้นหา ผลอาจไม่เหมือนเดิม → ค้นหาใหม่
+        moved_since = set(self._move_log[speculative['move_marker']:])
+        if moved_since:
+            start, end = speculative['scanned']
+            if any(p in moved_since for p in self.image_files[start:end]):
+                return None
+        return speculative['similar_images']
+
+    def record_move(self, img_path):
+        """บันทึกว่าไฟล์ถูกย้ายออกจากโฟลเดอร์แล้ว (ตัดออกจากรายการที่ต้องประมวลผลและค้นหา)"""
+        self._move_log.append(img_path)
+        self.image_files.discard(img_path)
+        self._predictions.pop(img_path, None)
+        hash_index = self.hash_index
+        if hash_index is not None:
+            hash_index.discard(img_path)
 
-    
     def show_decision_ui(self, ref_img_path, class_name, confidence, similar_images):
         """แสดง UI สำหรับการตัดสินใจและแสดงรูปที่คล้ายกัน"""
+        render_started = time.perf_counter()
         # สร้างหน้าต่างใหม่
         decision_window = tk.Toplevel(self.root)
         decision_window.title("ตัดสินใจจัดหมวดหมู่รูปภาพ")
         decision_window.geometry("1200x800")
         decision_window.configure(bg=self.style.BG_COLOR)
-        decision_window.protocol("WM_DELETE_WINDOW", lambda: self.on_decision_window_close(decision_window))
+        decision_window.protocol("WM_DELETE_WINDOW", lambda: self.on_decision_window_close(decision_window, ref_img_path))
         
         # กำหนดให้แสดงเต็มจอ
         decision_window.state('zoomed')
@@ -944,8 +3235,7 @@ class YOLOImageSimilaritySorter:
         
         try:
             # อ่านรูปและปรับขนาด
-            ref_img = Image.open(ref_img_path)
-            ref_img.thumbnail((400, 300))
+            ref_img = self.load_thumbnail(ref_img_path, REFERENCE_PREVIEW_SIZE)
             ref_photo = ImageTk.PhotoImage(ref_img)
             
             # เก็บรูปไว้ใน attributes ของหน้าต่าง
@@ -1024,31 +3314,15 @@ class YOLOImageSimilaritySorter:
             ttk.Label(bottom_frame, text="รูปที่คล้ายกัน:", style='Header.TLabel', 
                      background=self.style.SECONDARY_BG).pack(anchor=tk.W, pady=(0, 5))
             
-            # สร้าง scrollable frame สำหรับแสดงรูปที่คล้ายกัน
-            canvas = tk.Canvas(bottom_frame, bg=self.style.SECONDARY_BG, 
-                             highlightthickness=0)
-            scrollbar = ttk.Scrollbar(bottom_frame, orient="vertical", command=canvas.yview)
-            
-            scrollable_frame = ttk.Frame(canvas, style='TFrame')
-            scrollable_frame.bind(
-                "<Configure>",
-                lambda e: canvas.configure(scrollregion=canvas.bbox("all"))
-            )
-            
-            canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
-            canvas.configure(yscrollcommand=scrollbar.set)
-            
-            canvas.pack(side="left", fill="both", expand=True)
-            scrollbar.pack(side="right", fill="y")
-            
-            # เพิ่ม mouse wheel scrolling
-            canvas.bind("<MouseWheel>", lambda e: canvas.yview_scroll(int(-1*(e.delta/120)), "units"))
-            
-            # แสดงรูปที่คล้ายกัน
-            self.display_similar_images(scrollable_frame, similar_images)
+            # แสดงรูปที่คล้ายกัน (scrollable, สร้าง widget เฉพาะแถวที่มองเห็น)
+            decision_window.thumbnail_grid = self.display_similar_images(bottom_frame, similar_images)
             
             # เพิ่มการตรวจจับปุ่มกด
             decision_window.bind("<KeyPress>", lambda event: self.on_key_press_decision(event, decision_window, ref_img_path))
+            self.metrics.record('render', time.perf_counter() - render_started)
+
+            # ระหว่างที่ผู้ใช้ตัดสินใจ ให้เตรียมรูปถัดไปไว้ล่วงหน้า
+            self.start_speculation()
             
         except Exception as e:
             self.log(f"ข้อผิดพลาดในการแสดง UI: {e}", "error")
@@ -1058,156 +3332,15 @@ class YOLOImageSimilaritySorter:
             self.process_next_image()
     
     def display_similar_images(self, parent_frame, similar_images):
-        """แสดงรูปที่คล้ายกันใน scrollable frame (แก้ไข event binding)"""
+        """แสดงรูปที่คล้ายกันใน ThumbnailGrid (โหลด thumbnail ใน worker thread)"""
         print(f"📷 แสดงรูป {len(similar_images)} รูป")
         
         if not similar_images:
             ttk.Label(parent_frame, text="ไม่พบรูปที่คล้ายกัน", 
                     background=self.style.SECONDARY_BG).pack(pady=10)
-            return
-        
-        # กำหนดจำนวนคอลัมน์
-        max_cols = 4
-        
-        # ตัวแปรสำหรับ drag functionality
-        parent_frame.is_dragging = False
-        parent_frame.drag_start_widget = None
-        
-        # สร้าง grid layout
-        for i, (img_path, similarity) in enumerate(similar_images):
-            row = i // max_cols
-            col = i % max_cols
-            
-            try:
-                print(f"🔗 สร้างรูป {i+1}: {os.path.basename(img_path)}")
-                
-                # สร้าง frame สำหรับแต่ละรูป
-                img_frame = ttk.Frame(parent_frame, style='Card.TFrame', padding=5)
-                img_frame.grid(row=row, column=col, padx=5, pady=5, sticky='nsew')
-                
-                # ให้ frame ขยายเมื่อหน้าต่างถูกปรับขนาด
-                img_frame.columnconfigure(0, weight=1)
-                img_frame.rowconfigure(0, weight=1)
-                
-                # อ่านรูปและปรับขนาด
-                img = Image.open(img_path)
-                img.thumbnail((250, 200))
-                photo = ImageTk.PhotoImage(img)
-                
-                # เก็บ reference ของรูปไว้ใน dictionary
-                if not hasattr(parent_frame, 'photo_references'):
-                    parent_frame.photo_references = {}
-                parent_frame.photo_references[img_path] = photo
-                
-                # แสดงรูป (พร้อม click event)
-                img_label = ttk.Label(img_frame, image=photo, background=self.style.SECONDARY_BG)
-                img_label.pack(pady=(0, 5))
-                
-                # แสดงข้อมูล
-                filename = os.path.basename(img_path)
-                info_text = f"{filename}\nความคล้าย: {similarity:.2%}"
-                info_label = ttk.Label(img_frame, text=info_text, background=self.style.SECONDARY_BG,
-                                    justify=tk.CENTER, wraplength=200)
-                info_label.pack(pady=(0, 5))
-                
-                # ปุ่ม Unselect (เหมือนเดิม)
-                unselect_btn = ttk.Button(
-                    img_frame,
-                    text="Unselect",
-                    command=lambda path=os.path.basename(img_path), frame=img_frame: self.toggle_image_selection(path, frame),
-                    style='Unselect.TButton'
-                )
-                unselect_btn.pack(pady=(0, 5))
-                
-                # เก็บข้อมูลไว้ใน frame
-                img_frame.unselect_btn = unselect_btn
-                img_frame.img_path = img_path
-                img_frame.img_label = img_label
-                img_frame.info_label = info_label
-                
-                print(f"   📎 Binding events สำหรับรูป {i+1}...")
-                
-                # 🔧 แก้ไข: แยก event binding ออกจากกัน และใช้ลำดับที่ถูกต้อง
-                
-                # 1. ผูก Click Event ก่อน (สำคัญที่สุด)
-                def make_click_handler(path, frame):
-                    def handler(event):
-                        print(f"🖱️ CLICK EVENT: {os.path.basename(path)}")
-                        self.on_image_click(event, path, frame)
-                    return handler
-                
-                click_handler = make_click_handler(img_path, img_frame)
-                
-                # ผูก click กับทั้งรูปและข้อมูล
-                img_label.bind("<Button-1>", click_handler)
-                info_label.bind("<Button-1>", click_handler)
-                
-                print(f"   ✅ Click events bound สำหรับรูป {i+1}")
-                
-                # 2. ผูก Drag Events (อย่าให้ชนกับ Click)
-                def make_drag_start_handler(path, frame, parent):
-                    def handler(event):
-                        print(f"🎯 DRAG START: {os.path.basename(path)}")
-                        self.on_drag_start(event, path, frame, parent)
-                    return handler
-                
-                def make_drag_motion_handler(parent):
-                    def handler(event):
-                        self.on_drag_motion(event, parent)
-                    return handler
-                
-                def make_drag_end_handler(parent):
-                    def handler(event):
-                        print(f"🔚 DRAG END")
-                        self.on_drag_end(event, parent)
-                    return handler
-                
-                drag_start_handler = make_drag_start_handler(img_path, img_frame, parent_frame)
-                drag_motion_handler = make_drag_motion_handler(parent_frame)
-                drag_end_handler = make_drag_end_handler(parent_frame)
-                
-                # ผูก drag events เฉพาะกับรูป (ไม่ใช่ข้อมูล)
-                img_label.bind("<ButtonPress-1>", drag_start_handler, add="+")  # add="+" เพื่อไม่ override click
-                img_label.bind("<B1-Motion>", drag_motion_handler)
-                img_label.bind("<ButtonRelease-1>", drag_end_handler)
-                
-                print(f"   ✅ Drag events bound สำหรับรูป {i+1}")
-                
-                # 3. ผูก Hover Events
-                def make_hover_enter_handler(frame):
-                    def handler(event):
-                        self.on_image_hover_enter(event, frame)
-                    return handler
-                
-                def make_hover_leave_handler(frame):
-                    def handler(event):
-                        self.on_image_hover_leave(event, frame)
-                    return handler
-                
-                hover_enter_handler = make_hover_enter_handler(img_frame)
-                hover_leave_handler = make_hover_leave_handler(img_frame)
-                
-                img_label.bind("<Enter>", hover_enter_handler)
-                img_label.bind("<Leave>", hover_leave_handler)
-                
-                print(f"   ✅ Hover events bound สำหรับรูป {i+1}")
-                
-                # 4. อัปเดตสถานะ visual เริ่มต้น
-                self.update_image_visual_state(img_frame)
-                
-                print(f"   ✅ รูป {i+1} เสร็จสมบูรณ์: {os.path.basename(img_path)}")
-                
-            except Exception as e:
-                print(f"❌ Error displaying image {img_path}: {e}")
-                import traceback
-                traceback.print_exc()
-                continue
+            return None
         
-        # กำหนดน้ำหนักของทุก column เท่ากัน
-        for col in range(max_cols):
-            parent_frame.columnconfigure(col, weight=1)
-        
-        print(f"✅ display_similar_images เสร็จสิ้น - สร้าง {len(similar_images)} รูป")
+        return ThumbnailGrid(self, parent_frame, similar_images, self.thumbnail_executor)
 
     # 2. แก้ไข on_image_click ให้ robust ขึ้น
     def on_image_click(self, event, img_path, img_frame):
@@ -1465,86 +3598,94 @@ class YOLOImageSimilaritySorter:
     
     def on_category_decision(self, window, ref_img_path, category):
         """ดำเนินการย้ายรูปตามการตัดสินใจ (แบบใหม่: Unselected ไปตรงข้าม)"""
+        class_name, confidence = self._current_prediction
         if category == 'skip':
+            self.image_files.discard(ref_img_path)
+            self.journal_record(ref_img_path, None, class_name, confidence)
+            self.flush_journal(sync=True)
             window.destroy()
             # Skip to next image
             self.current_index += 1
             self.process_next_image()
             return
             
-        # ย้ายรูปต้นแบบ
-        ref_filename = os.path.basename(ref_img_path)
-        ref_target_path = os.path.join(self.target_folders[category], ref_filename)
-        
-        try:
-            shutil.move(ref_img_path, ref_target_path)
-            self.log(f"ย้ายรูปต้นแบบไปยังโฟลเดอร์ {category}: {ref_filename}", "success")
-            
-            # อัปเดตสถิติตามหมวดหมู่ที่เลือก
-            if category == 'car':
-                self.stats['car'] += 1
-            elif category == 'person':  # เพิ่มเงื่อนไขนี้
-                self.stats['person'] += 1
-            else:  # not_car
-                self.stats['not_car'] += 1
-                
-            self.stats['processed'] += 1
-            
-            # ย้ายรูปที่คล้ายกัน (แบบใหม่: แยกตาม selected/unselected)
-            moved_selected_count = 0
-            moved_unselected_count = 0
-            error_count = 0
-            
-            # กำหนดโฟลเดอร์ตรงข้าม
-            opposite_category = 'not_car' if category in ['car', 'person'] else 'car'
-            
-            for img_path, _ in self.similar_images:
-                # ข้ามตัวเอง
-                if os.path.abspath(img_path) == os.path.abspath(ref_img_path):
-                    continue
-                    
-                try:
-                    filename = os.path.basename(img_path)
-                    
-                    # ตรวจสอบว่ารูปนี้ถูก unselect หรือไม่
-                    if img_path in self.unselected_images:
-                        # รูป Unselected → ไปโฟลเดอร์ตรงข้าม
-                        target_path = os.path.join(self.target_folders[opposite_category], filename)
-                        
-                        # ตรวจสอบชื่อซ้ำ
-                        if os.path.exists(target_path):
-                            name, ext = os.path.splitext(filename)
-                            target_path = os.path.join(self.target_folders[opposite_category], 
-                                                    f"{name}_unselected_{moved_unselected_count}{ext}")
-                            
-                        shutil.move(img_path, target_path)
-                        moved_unselected_count += 1
-                        
-                        self.log(f"  รูป Unselected: {filename} → {opposite_category}", "warning")
-                        
-                    else:
-                        # รูป Selected → ไปโฟลเดอร์ตามที่เลือก
-                        target_path = os.path.join(self.target_folders[category], filename)
-                        
-                        # ตรวจสอบชื่อซ้ำ
-                        if os.path.exists(target_path):
-                            name, ext = os.path.splitext(filename)
-                            target_path = os.path.join(self.target_folders[category], 
-                                                    f"{name}_selected_{moved_selected_count}{ext}")
-                            
-                        shutil.move(img_path, target_path)
-                        moved_selected_count += 1
-                        
-                        self.log(f"  รูป Selected: {filename} → {category}", "success")
-                        
-                except Exception as e:
-                    self.log(f"ข้อผิดพลาดในการย้ายรูป {filename}: {e}", "error")
+        # กำหนดโฟลเดอร์ตรงข้าม
+        opposite_category = 'not_car' if category in ['car', 'person'] else 'car'
+
+        # รูปต้นแบบเป็นรายการแรก (ถ้าย้ายไม่สำเร็จจะไม่ย้ายรูปที่คล้ายกัน)
+        moves = [(ref_img_path, self.output_path(ref_img_path, category, create=False), None)]
+        for img_path, _ in self.similar_images:
+            # ข้ามตัวเอง (path มาจาก self.image_files เหมือนกัน เทียบ string ได้เลย)
+            if img_path == ref_img_path:
+                continue
+            # รูป Unselected → ไปโฟลเดอร์ตรงข้าม, รูป Selected → ไปโฟลเดอร์ตามที่เลือก
+            if img_path in self.unselected_images:
+                moves.append((img_path, self.output_path(img_path, opposite_category, create=False), 'unselected'))
+            else:
+                moves.append((img_path, self.output_path(img_path, category, create=False), 'selected'))
+
+        # ปิดหน้าต่าง แล้วย้ายไฟล์ใน background (UI ไม่ค้างระหว่างย้ายรูปจำนวนมาก)
+        window.destroy()
+        if len(moves) > 1:
+            self.log(f"กำลังย้ายรูป {len(moves)} รูป...", "info")
+        self.move_executor.submit(
+            moves,
+            on_done=lambda results, not_attempted: self.ui.call(
+                self._on_decision_moved, results, not_attempted, category, opposite_category,
+                class_name, confidence),
+            primary=True,
+        )
+
+    def _on_decision_moved(self, results, not_attempted, category, opposite_category, class_name, confidence):
+        """อัปเดตสถิติ/log หลังย้ายไฟล์ของการตัดสินใจเสร็จ แล้วไปยังรูปถัดไป (Tk thread)
+
+        ไฟล์ใน not_attempted ไม่ได้ถูกแตะเลย จึงไม่นับเป็น move_failed (ยังอยู่ในรายการให้ทำต่อ)
+        """
+        moved_selected_count = 0
+        moved_unselected_count = 0
+        error_count = 0
+
+        for src, dst, label, error in results:
+            filename = os.path.basename(src)
+            if error is not None:
+                self.stats['move_failed'] += 1
+                if label is None:
+                    self.log(f"ข้อผิดพลาดในการย้ายรูปต้นแบบ: {error}", "error")
+                else:
+                    self.log(f"ข้อผิดพลาดในการย้ายรูป {filename}: {error}", "error")
                     error_count += 1
-            
-            # อัปเดตสถิติรูปที่คล้ายกัน
-            total_moved = moved_selected_count + moved_unselected_count
-            self.stats['similar_moved'] += total_moved
-            
+                continue
+
+            self.record_move(src)
+            if label is None:
+                self.journal_record(src, dst, class_name, confidence, category, 'processed')
+                self.log(f"ย้ายรูปต้นแบบไปยังโฟลเดอร์ {category}: {filename}", "success")
+
+                # อัปเดตสถิติตามหมวดหมู่ที่เลือก
+                if category == 'car':
+                    self.stats['car'] += 1
+                elif category == 'person':  # เพิ่มเงื่อนไขนี้
+                    self.stats['person'] += 1
+                else:  # not_car
+                    self.stats['not_car'] += 1
+                self.stats['processed'] += 1
+            elif label == 'unselected':
+                self.journal_record(src, dst, None, None, 'similar_moved')
+                moved_unselected_count += 1
+                self.log(f"  รูป Unselected: {filename} → {opposite_category}", "warning")
+            else:
+                self.journal_record(src, dst, None, None, 'similar_moved')
+                moved_selected_count += 1
+                self.log(f"  รูป Selected: {filename} → {category}", "success")
+
+        if not_attempted:
+            reason = not_attempted[0][3]
+            self.log(f"ไม่ได้ย้ายรูป {len(not_attempted)} รูป ({reason})", "warning")
+
+        # อัปเดตสถิติรูปที่คล้ายกัน
+        self.stats['similar_moved'] += moved_selected_count + moved_unselected_count
+
+        if results and results[0][3] is None:
             # แสดงสรุปผลลัพธ์
             summary_msg = (
                 f"สรุปการย้ายรูป:\n"
@@ -1553,26 +3694,18 @@ class YOLOImageSimilaritySorter:
                 f"  - ข้อผิดพลาด: {error_count} รูป"
             )
             self.log(summary_msg, "info")
-            
-        except Exception as e:
-            self.log(f"ข้อผิดพลาดในการย้ายรูปต้นแบบ: {e}", "error")
-        
-        # อัปเดตสถิติ
-        self.root.after(0, self.update_stats)
-        
-        # ปิดหน้าต่าง
-        window.destroy()
-        
+
+        # บันทึกการตัดสินใจลงดิสก์ก่อนไปรูปถัดไป แล้วอัปเดตสถิติ
+        self.flush_journal(sync=True)
+        self.request_stats_update()
+
         # ไปยังรูปถัดไป
         self.current_index += 1
         self.process_next_image()
     
-    def on_decision_window_close(self, window):
+    def on_decision_window_close(self, window, ref_img_path):
         """จัดการเมื่อปิดหน้าต่างตัดสินใจ (เทียบเท่ากับการกด Skip)"""
-        window.destroy()
-        # Skip to next image
-        self.current_index += 1
-        self.process_next_image()
+        self.on_category_decision(window, ref_img_path, 'skip')
     
     def stop_sorting(self):
         """หยุดกระบวนการคัดแยกรูปภาพ"""
@@ -1581,9 +3714,17 @@ class YOLOImageSimilaritySorter:
             
         # ตั้งค่าตัวแปรเพื่อหยุดการทำงาน
         self.is_running = False
+        with self._speculation_lock:
+            self._speculation_generation += 1
+        self.flush_prediction_cache()
+        self.flush_journal(sync=True)
         self.log("กำลังหยุดการทำงาน...", "warning")
         
         # อัปเดตสถานะปุ่ม
+        self.reset_controls()
+        
+    def reset_controls(self):
+        """ปุ่มกลับเป็นสถานะพร้อมเริ่มใหม่ (Tk thread)"""
         self.stop_button.config(state=tk.DISABLED)
         self.start_button.config(state=tk.NORMAL)
         self.not_car_auto_button.config(state=tk.NORMAL)
@@ -1592,12 +3733,16 @@ class YOLOImageSimilaritySorter:
     def finish_sorting(self):
         """เสร็จสิ้นกระบวนการคัดแยกรูปภาพ"""
         self.is_running = False
+        self.flush_prediction_cache()
+        if self.journal is not None:
+            if self.current_index >= len(self.image_files):
+                # ทำครบทุกไฟล์แล้ว ไม่ต้องทำต่อครั้งหน้า
+                self.journal.complete()
+            else:
+                self.journal.flush()
         
         # อัปเดตสถานะปุ่ม
-        self.root.after(0, lambda: self.stop_button.config(state=tk.DISABLED))
-        self.root.after(0, lambda: self.start_button.config(state=tk.NORMAL))
-        self.root.after(0, lambda: self.not_car_auto_button.config(state=tk.NORMAL))
-        self.root.after(0, lambda: self.car_auto_button.config(state=tk.NORMAL))
+        self.reset_controls()
         
         # แสดงสรุปผล
         summary = (
@@ -1611,13 +3756,27 @@ class YOLOImageSimilaritySorter:
             f"จำนวนภาพที่จัดเป็น 'not car' (อัตโนมัติ): {self.stats['auto_not_car']} ไฟล์\n"
             f"จำนวนภาพที่ข้าม: {self.stats['skipped']} ไฟล์\n"
             f"จำนวนภาพที่คล้ายกันที่ถูกย้าย: {self.stats['similar_moved']} ไฟล์\n"
+            f"จำนวนภาพที่ย้ายไม่สำเร็จ: {self.stats['move_failed']} ไฟล์\n"
         )
         
         self.log(summary, "success")
+        self.export_metrics()
         
         # แสดงข้อความสรุปในกล่องข้อความแจ้งเตือน
         self.root.after(100, lambda: messagebox.showinfo("สรุปผลการทำงาน", summary))
         
+    METRICS_FILENAME = '.sort_metrics.json'
+
+    def export_metrics(self):
+        """เขียนสรุปเวลาต่อขั้นของรอบนี้เป็น JSON ไว้ในโฟลเดอร์รูปภาพ"""
+        self.update_stats()
+        metrics_path = os.path.join(self.folder_path, self.METRICS_FILENAME)
+        try:
+            self.metrics.export(metrics_path)
+            self.log(f"บันทึกเวลาการทำงานแต่ละขั้นไว้ที่ {metrics_path}", "info")
+        except OSError as e:
+            self.log(f"บันทึกเวลาการทำงานไม่สำเร็จ: {e}", "warning")
+        
     def resize_image_for_display(self, image, max_width=800, max_height=600):
         """ปรับขนาดภาพให้พอดีกับหน้าจอ แต่ยังคงอัตราส่วนเดิม"""
         height, width = image.shape[:2]
@@ -1640,6 +3799,179 @@ class YOLOImageSimilaritySorter:
         
         return resized_image
 
+class HeadlessSorter:
+    """รันโหมด not_car_auto / car_auto โดยไม่ใช้ Tk (สำหรับ server และ cron job)
+
+    ถ้า recursive และ shards > 1 โฟลเดอร์ย่อยชั้นแรก (shard) จะถูกไล่/decode พร้อมกันหลาย thread
+    โดยใช้โมเดลตัวเดียวกัน (การ inference ยังทีละ batch ผ่าน ModelManager.inference_lock)
+    """
+
+    def __init__(self, folder_path, mode, model_path='best-cls-v2.pt', batch_size=32,
+                 prefetch_depth=128, progress_every=1000, use_cache=True, cache_size=2_000_000,
+                 watch=False, watch_interval=2.0, recursive=False, shards=1, output=None):
+        self.folder_path = folder_path
+        self.mode = mode
+        self.model_path = model_path
+        self.batch_size = batch_size
+        self.prefetch_depth = prefetch_depth
+        self.use_cache = use_cache
+        self.cache_size = cache_size
+        self.watch = watch
+        self.watch_interval = watch_interval
+        self.recursive = recursive
+        self.shards = max(1, int(shards))
+        self.progress_every = max(1, int(progress_every))
+        self.output = output or sys.stdout
+        self.target_class_keywords = list(TARGET_CLASS_KEYWORDS)
+        self.model = None
+        self.stats = new_stats()
+        self.metrics = PipelineMetrics()
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._started = None
+
+    def emit(self, event, **fields):
+        """เขียน progress เป็น JSON หนึ่งบรรทัด (อ่านต่อด้วยเครื่องได้)"""
+        record = {'event': event, 'time': round(time.time(), 3)}
+        record.update(fields)
+        with self._lock:
+            self.output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.output.flush()
+
+    def run(self):
+        """ประมวลผลทั้งโฟลเดอร์ คืนค่า dict สถิติ (watch mode ทำงานจนกว่าจะกด Ctrl+C)"""
+        self._started = time.monotonic()
+
+        self.emit('load_model', model=self.model_path, device=str(ModelManager.select_device()))
+        self.model = ModelManager.get(self.model_path)
+
+        target_folders = make_target_folders(self.folder_path)
+        self.stats = new_stats()
+        self.metrics.reset()
+        self.errors = 0
+        self._stop.clear()
+        self.emit('start', mode=self.mode, folder=self.folder_path, watch=self.watch,
+                  recursive=self.recursive)
+
+        cache = None
+        if self.use_cache:
+            cache = PredictionCache.open_default(ModelManager.checksum(self.model_path),
+                                                 max_entries=self.cache_size)
+        interrupted = False
+        try:
+            if self.recursive and self.shards > 1 and not self.watch:
+                shards = list_shards(self.folder_path, target_folders.values())
+                self.emit('shards', count=len(shards), workers=self.shards)
+                with ThreadPoolExecutor(max_workers=self.shards) as pool:
+                    futures = [pool.submit(self._sort_paths,
+                                           iter_image_paths(shard, recursive, target_folders.values()),
+                                           target_folders, cache)
+                               for shard, recursive in shards]
+                    try:
+                        for future in futures:
+                            future.result()
+                    except KeyboardInterrupt:
+                        self._stop.set()
+                        raise
+            else:
+                # ส่งไฟล์เข้า classifier ระหว่างที่ยังไล่โฟลเดอร์ไม่เสร็จ จำนวนทั้งหมดจึงนับเพิ่มไปเรื่อยๆ
+                scanner = FolderScanner(self.folder_path, self.watch_interval,
+                                        recursive=self.recursive, exclude=target_folders.values())
+                source = scanner.watch(lambda: not self._stop.is_set()) if self.watch else scanner.scan()
+                self._sort_paths(source, target_folders, cache)
+        except KeyboardInterrupt:
+            interrupted = True
+            self._stop.set()
+        finally:
+            if cache is not None:
+                cache.close()
+
+        elapsed = time.monotonic() - self._started
+        self.emit('done', stats=self.stats, errors=self.errors, interrupted=interrupted,
+                  elapsed_sec=round(elapsed, 3), metrics=self.metrics.summary())
+        return self.stats
+
+    def _sort_paths(self, img_paths, target_folders, cache):
+        """จำแนกและย้ายไฟล์จาก img_paths (เรียกพร้อมกันได้หลาย thread)"""
+        def discovered():
+            for img_path in img_paths:
+                with self._lock:
+                    self.stats['total'] += 1
+                yield img_path
+
+        classifier = BatchClassifier(self.model, self.batch_size, self.prefetch_depth, cache=cache,
+                                     metrics=self.metrics)
+        for img_path, class_name, confidence, error in classifier.classify(discovered()):
+            if self._stop.is_set():
+                break
+            delta = new_stats()
+            if error is None:
+                try:
+                    started = time.perf_counter()
+                    if apply_auto_rule(self.mode, img_path, class_name, confidence, target_folders,
+                                       delta, self.target_class_keywords, self.folder_path):
+                        self.metrics.record('move', time.perf_counter() - started)
+                except Exception as e:
+                    delta['move_failed'] += 1
+                    error = str(e)
+            if error is not None:
+                self.emit('error', file=img_path, error=error)
+
+            with self._lock:
+                for key, value in delta.items():
+                    self.stats[key] += value
+                if error is not None:
+                    self.errors += 1
+                done = self.stats['processed'] + self.errors
+                total = self.stats['total']
+            if done % self.progress_every == 0:
+                elapsed = time.monotonic() - self._started
+                self.emit('progress', done=done, total=total,
+                          images_per_sec=round(done / elapsed, 2) if elapsed > 0 else None)
+
+def cli_main(argv=None):
+    """Entry point แบบ headless: python classify_image.py FOLDER --mode not_car_auto"""
+    parser = argparse.ArgumentParser(description="คัดแยกรูปภาพแบบอัตโนมัติโดยไม่ใช้หน้าต่าง (headless)")
+    parser.add_argument('folder', help="โฟลเดอร์รูปภาพ")
+    parser.add_argument('--mode', choices=['not_car_auto', 'car_auto'], required=True,
+                        help="โหมดการคัดแยก")
+    parser.add_argument('--model', default='best-cls-v2.pt', help="ไฟล์น้ำหนักโมเดล")
+    parser.add_argument('--batch-size', type=int, default=32, help="จำนวนรูปต่อ batch")
+    parser.add_argument('--prefetch-depth', type=int, default=128,
+                        help="จำนวนรูปที่ decode ล่วงหน้าได้สูงสุด (จำกัดหน่วยความจำ)")
+    parser.add_argument('--progress-every', type=int, default=1000,
+                        help="แสดง progress ทุกๆ กี่รูป")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="ไม่ใช้ cache ผลทำนาย (ทำนายทุกรูปใหม่)")
+    parser.add_argument('--cache-size', type=int, default=2_000_000,
+                        help="จำนวนผลทำนายสูงสุดที่เก็บใน cache")
+    parser.add_argument('--watch', action='store_true',
+                        help="เฝ้าดูไฟล์ใหม่ที่วางเพิ่มในโฟลเดอร์และคัดแยกต่อเนื่อง (หยุดด้วย Ctrl+C)")
+    parser.add_argument('--watch-interval', type=float, default=2.0,
+                        help="วินาทีระหว่างการตรวจไฟล์ใหม่ใน watch mode")
+    parser.add_argument('--recursive', action='store_true',
+                        help="รวมไฟล์ในโฟลเดอร์ย่อย (ผลลัพธ์คงโครงสร้างโฟลเดอร์ย่อยเดิม)")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="จำนวนโฟลเดอร์ย่อยที่ประมวลผลพร้อมกัน (ใช้กับ --recursive, ไม่ใช้กับ --watch)")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.folder):
+        parser.error(f"ไม่พบโฟลเดอร์: {args.folder}")
+
+    sorter = HeadlessSorter(args.folder, args.mode, model_path=args.model,
+                            batch_size=args.batch_size, prefetch_depth=args.prefetch_depth,
+                            progress_every=args.progress_every,
+                            use_cache=not args.no_cache, cache_size=args.cache_size,
+                            watch=args.watch, watch_interval=args.watch_interval,
+                            recursive=args.recursive, shards=args.shards)
+    try:
+        sorter.run()
+    except Exception as e:
+        sorter.emit('fatal', error=str(e))
+        return 1
+    return 0
+
 def main():
     # ตรวจสอบ dependencies ที่จำเป็น
     try:
@@ -1702,6 +4034,13 @@ def main():
     # เริ่มแอปพลิเคชัน
     app = YOLOImageSimilaritySorter(root)
     root.mainloop()
+    app.log_sink.close()
 
 if __name__ == "__main__":
+    # device เดียวกับที่ ModelManager ใช้โหลดโมเดลจริง (CUDA → MPS → CPU)
+    print(f"##############Device: {ModelManager.select_device()}##############", file=sys.stderr)
+
+    # มี argument → รันแบบ headless, ไม่มี → เปิดหน้าต่าง Tk ตามเดิม
+    if len(sys.argv) > 1:
+        sys.exit(cli_main())
     main()
\ No newline at end of file
@@ -0,0 +1,112 @@
+"""Feature ความคล้ายของรูป (HSV histogram, average/difference hash, ORB)
+
+แยกจาก classify_image เพื่อให้ worker process ของ ParallelFeatureExtractor import ได้
+โดยไม่ต้องโหลด torch, ultralytics หรือ tkinter
+"""
+import cv2
+import numpy as np
+from PIL import Image
+
+# ค่าคงที่ของ feature ที่ใช้วัดความคล้าย
+FEATURE_IMAGE_SIZE = (128, 128)
+HIST_SIZE = [8, 8]
+HIST_RANGES = [0, 180, 0, 256]
+HIST_CHANNELS = [0, 1]
+
+# (ตัวหาร, flag) ของการ decode แบบย่อขนาด เรียงจากเล็กสุดไปใหญ่สุด
+_REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+def read_image_reduced(img_path, min_size):
+    """decode รูปที่ความละเอียดต่ำสุดที่ด้านสั้นยัง >= min_size
+
+    JPEG ถูกย่อใน DCT domain ระหว่าง decode จึงไม่ต้อง decode เต็มความละเอียดแล้วทิ้ง
+    ไฟล์ชนิดอื่นยังใช้ cv2.imread ปกติ
+    """
+    try:
+        with Image.open(img_path) as img:  # อ่านแค่ header
+            is_jpeg = img.format == 'JPEG'
+            short_side = min(img.size)
+    except Exception:
+        return cv2.imread(img_path)
+
+    if is_jpeg:
+        for factor, flag in _REDUCED_DECODE_FLAGS:
+            if short_side // factor >= min_size:
+                image = cv2.imread(img_path, flag)
+                if image is not None:
+                    return image
+                break
+    return cv2.imread(img_path)
+
+def hash_to_int(bits):
+    """แปลง hash แบบ bool 8x8 เป็นจำนวนเต็ม 64 บิต (บิตแรกคือบิตสูงสุด)"""
+    return int.from_bytes(np.packbits(np.asarray(bits, dtype=np.bool_).reshape(-1)).tobytes(), 'big')
+
+def compute_image_features(image, with_orb=True):
+    """คำนวณ feature ความคล้ายจากรูป BGR: HSV histogram, average hash, difference hash, ORB
+
+    with_orb=False ข้าม ORB (ส่วนที่แพงที่สุด) ไว้คำนวณทีหลังเฉพาะรูปที่ต้องใช้
+    """
+    image = cv2.resize(image, FEATURE_IMAGE_SIZE)
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    # 1. Histogram
+    hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    hist = cv2.calcHist([hsv], HIST_CHANNELS, None, HIST_SIZE, HIST_RANGES)
+    cv2.normalize(hist, hist, 0, 1, cv2.NORM_MINMAX)
+
+    # 2. Average Hash (เก็บเป็นจำนวนเต็ม 64 บิต)
+    small_img = cv2.resize(gray, (8, 8))
+    avg_hash = hash_to_int(small_img >= small_img.mean())
+
+    # 3. Difference Hash (เทียบ pixel กับตัวถัดไปทางขวาทั้งแถวในครั้งเดียว)
+    resize_img = cv2.resize(gray, (9, 8))
+    d_hash = hash_to_int(resize_img[:, :-1] > resize_img[:, 1:])
+
+    features = {
+        'hist': hist.astype(np.float32).reshape(-1),
+        'avg_hash': avg_hash,
+        'd_hash': d_hash,
+    }
+
+    # 4. ORB
+    if with_orb:
+        features['orb'] = compute_orb_descriptors(gray)
+    return features
+
+def compute_orb_descriptors(gray):
+    """ORB descriptor ของรูป grayscale ขนาด FEATURE_IMAGE_SIZE"""
+    orb = cv2.ORB_create(nfeatures=1000)
+    _, descriptors = orb.detectAndCompute(gray, None)
+    return descriptors
+
+def extract_image_features(img_path, with_orb=True):
+    """อ่านไฟล์แล้วคำนวณ feature (คืน None ถ้าอ่านไม่ได้)"""
+    image = read_image_reduced(img_path, min(FEATURE_IMAGE_SIZE))
+    if image is None:
+        return None
+    return compute_image_features(image, with_orb)
+
+def extract_orb_descriptors(img_path):
+    """อ่านไฟล์แล้วคำนวณเฉพาะ ORB descriptor (คืน None ถ้าอ่านไม่ได้หรือไม่มี keypoint)"""
+    image = read_image_reduced(img_path, min(FEATURE_IMAGE_SIZE))
+    if image is None:
+        return None
+    gray = cv2.cvtColor(cv2.resize(image, FEATURE_IMAGE_SIZE), cv2.COLOR_BGR2GRAY)
+    return compute_orb_descriptors(gray)
+
+def init_feature_worker():
+    """initializer ของ worker process ใน ProcessPoolExecutor"""
+    # แต่ละ process ใช้ OpenCV thread เดียว ไม่ให้แย่ง core กันเอง
+    cv2.setNumThreads(1)
+
+def extract_features_safe(img_path, with_orb=True):
+    """ใช้ใน worker process: คืน None แทนการโยน exception ข้าม process"""
+    try:
+        return extract_image_features(img_path, with_orb)
+    except Exception:
+        return None
@@ -0,0 +1,36 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classify_image import ImagePrefetcher
+
+
+def slow_paths(count, delay=0.05):
+    for i in range(count):
+        time.sleep(delay)
+        yield f"img_{i}.jpg"
+
+
+def test_early_close_does_not_submit_after_shutdown(monkeypatch):
+    errors = []
+    monkeypatch.setattr(threading, "excepthook", errors.append)
+
+    prefetcher = ImagePrefetcher(slow_paths(20), decode=lambda path: path, depth=2, workers=1)
+    seen = []
+    for img_path, image in prefetcher:
+        seen.append(image)
+        if len(seen) == 3:
+            break
+
+    prefetcher._producer.join(timeout=2)
+    assert not prefetcher._producer.is_alive()
+    assert seen == ["img_0.jpg", "img_1.jpg", "img_2.jpg"]
+    assert errors == []
+
+
+def test_yields_all_images_in_order():
+    prefetcher = ImagePrefetcher([f"img_{i}.jpg" for i in range(10)], decode=str.upper, depth=3, workers=2)
+    assert [image for _, image in prefetcher] == [f"IMG_{i}.JPG" for i in range(10)]